@@ -1,5 +1,8 @@
 import ee
 
+import ee_cache
+import utils
+
 # set user name
 __USERNAME__ = 'hafnersailing'
 
@@ -22,7 +25,7 @@ def get_orbit_numbers(city) -> dict:
 
     dict_orbit_numbers = {}
     for orbit in ['asc', 'desc']:
-        orbit_numbers = city_metadata.get(f'{orbit}Orbits').getInfo().split(' ')
+        orbit_numbers = ee_cache.get_info(city_metadata.get(f'{orbit}Orbits')).split(' ')
         if not orbit_numbers[0] == '-1':
             orbit_numbers = [int(n) for n in orbit_numbers]
         else:
@@ -32,12 +35,13 @@ def get_orbit_numbers(city) -> dict:
 
 
 # retrieve Global Urban Footprint (GUF) data
+@utils.memoize_graph()
 def get_guf(city):
 
     # first finding out with GUF tiles intersect with bounding box of city
     bounding_boxes = ee.FeatureCollection(f'users/{__USERNAME__}/urban_data/GUF_bounding_boxes')
     intersections = bounding_boxes.filterBounds(get_bbox(city))
-    n_tiles = intersections.size().getInfo()
+    n_tiles = ee_cache.get_info(intersections.size())
     if n_tiles == 0:
         print(f'No GUF tiles found for {city}')
     intersections = intersections.toList(n_tiles)
@@ -46,7 +50,7 @@ def get_guf(city):
     tiles = []
     for i in range(n_tiles):
         feature = intersections.get(i)
-        file_name = ee.Feature(feature).get('fileName').getInfo()
+        file_name = ee_cache.get_info(ee.Feature(feature).get('fileName'))
         asset_name = f'users/{__USERNAME__}/GUF/{file_name}'
         tile = ee.Image(asset_name)
         tiles.append(tile)
@@ -62,6 +66,7 @@ def get_guf(city):
     return guf
 
 
+@utils.memoize_graph()
 def get_wsf(city):
 
     wsf = ee.Image(f'users/{__USERNAME__}/WSF/WSF2015_{city}') \
@@ -0,0 +1,147 @@
+import argparse
+import json
+import os
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+# the simulated backend has to replace the ee client before any module of the project is imported
+import ee_sim
+ee = ee_sim.install()
+
+from download_manager.config import config
+
+import export
+import gee_download
+import patch_geometry
+import points
+import sampling
+import scheduler
+import utils
+
+
+def argument_parser():
+    parser = argparse.ArgumentParser(description='Offline benchmarks on a simulated earth engine backend')
+    parser.add_argument('-c', '--config-file', dest='config_file', default='stockholm_test',
+                        help='config used for the benchmarks')
+    parser.add_argument('--patches', type=int, default=100, help='number of sampled patches')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 8], help='worker counts to benchmark')
+    parser.add_argument('--latency', type=float, default=0.05, help='simulated seconds per request')
+    parser.add_argument('--jitter', type=float, default=0., help='simulated extra latency per request')
+    parser.add_argument('--failure-rate', dest='failure_rate', type=float, default=0.,
+                        help='probability of a simulated request or task failing')
+    parser.add_argument('--max-tasks', dest='max_tasks', type=int, default=3000,
+                        help='simulated limit of concurrently running tasks')
+    parser.add_argument('--task-duration', dest='task_duration', type=float, default=0.5,
+                        help='simulated seconds a task takes to complete')
+    parser.add_argument('--output', default=None, help='json file the results are written to')
+    return parser
+
+
+def setup(config_file: str):
+    cfg = config.new_config()
+    cfg.merge_from_file(f'configs/{config_file}.yaml')
+    cfg.NAME = config_file
+    cfg.DOWNLOAD.POLL_INTERVAL = 0.05
+    cfg.DOWNLOAD.MAX_POLL_INTERVAL = 0.5
+    return cfg
+
+
+def random_points(cfg, n: int, seed: int = 0) -> list:
+    # points uniformly distributed over the roi with random density zones, none of them in zone 0
+    rng = np.random.default_rng(seed)
+    lng = rng.uniform(*cfg.ROI.LNG_RANGE, n)
+    lat = rng.uniform(*cfg.ROI.LAT_RANGE, n)
+    zones = rng.integers(1, 4, n)
+    return [{'type': 'Feature', 'geometry': {'type': 'Point', 'coordinates': [float(x), float(y)]},
+             'properties': {'densityZone': int(zone)}} for x, y, zone in zip(lng, lat, zones)]
+
+
+def measure(func: callable, *args) -> dict:
+    ee_sim.reset()
+    tracemalloc.start()
+    start = time.perf_counter()
+    value = func(*args)
+    seconds = time.perf_counter() - start
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {'seconds': seconds, 'requests': ee_sim.stats(), 'n_requests': ee_sim.n_requests(),
+            'peak_memory_mb': peak_memory / 2 ** 20, 'value': value}
+
+
+def run_download(cfg) -> tuple:
+    # same steps as the main block of gee_download
+    date_range = utils.extract_date_range(cfg)
+    features = points.iter_sampled_features(points.points_files(cfg))
+    patches = patch_geometry.iter_bounds(cfg, features)
+
+    export_scheduler = scheduler.from_config(cfg)
+    export_scheduler.start()
+    start = time.perf_counter()
+    n_patches = gee_download.submit_patches(cfg, patches, date_range, export_scheduler)
+    submission_seconds = time.perf_counter() - start
+    export_scheduler.join()
+    return n_patches, submission_seconds
+
+
+def bench_download(cfg, n_patches: int, workers: int) -> dict:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        cfg.PATH = tmp_dir + os.sep
+        cfg.DOWNLOAD.WORKERS = workers
+        with open(f'{cfg.PATH}points_{cfg.ROI.ID}.geojson', 'w') as f:
+            json.dump({'type': 'FeatureCollection', 'features': random_points(cfg, n_patches)}, f)
+        result = measure(run_download, cfg)
+
+    n_patches, submission_seconds = result.pop('value')
+    result.update({
+        'name': f'gee_download (workers={workers})',
+        'patches': n_patches,
+        'submission_seconds': submission_seconds,
+        'patches_per_second': n_patches / submission_seconds,
+        'requests_per_patch': result['n_requests'] / n_patches
+    })
+    return result
+
+
+def bench_density_sampling(cfg) -> dict:
+    result = measure(sampling.density_sampling, cfg)
+    result.pop('value')
+    result['name'] = 'sampling.density_sampling'
+    return result
+
+
+def bench_construct_task(cfg, n: int) -> dict:
+    # construct_task exports the whole roi to drive if no sampling is applied
+    cfg.DOWNLOAD.TYPE = 'drive'
+    cfg.SAMPLING.TYPE = 'none'
+    cfg.BBOX = config.CfgNode({'ID': cfg.ROI.ID})
+    img = ee.Image(1)
+    result = measure(lambda: [export.construct_task(cfg, img) for _ in range(n)])
+    result.pop('value')
+    result.update({'name': 'export.construct_task', 'tasks': n, 'requests_per_task': result['n_requests'] / n})
+    return result
+
+
+if __name__ == '__main__':
+    args = argument_parser().parse_args()
+    ee_sim.configure(latency=args.latency, jitter=args.jitter, failure_rate=args.failure_rate,
+                     max_tasks=args.max_tasks, task_duration=args.task_duration)
+
+    results = []
+    for workers in args.workers:
+        results.append(bench_download(setup(args.config_file), args.patches, workers))
+    results.append(bench_density_sampling(setup(args.config_file)))
+    results.append(bench_construct_task(setup(args.config_file), args.patches))
+
+    for result in results:
+        line = f'{result["name"]}: {result["seconds"]:.2f}s, {result["n_requests"]} requests, ' \
+               f'{result["peak_memory_mb"]:.1f} MB peak'
+        if 'patches_per_second' in result:
+            line += f', {result["patches_per_second"]:.1f} patches/s, {result["requests_per_patch"]:.1f} requests/patch'
+        print(line)
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=4)
@@ -29,6 +29,8 @@ def rasterize(fc: ee.FeatureCollection, layer_name: str) -> ee.Image:
     return img
 
 
+@utils.memoize_graph('GEE_USERNAME', 'BUILDING_FOOTPRINTS.ASSETS', 'ROI.LNG_RANGE', 'ROI.LAT_RANGE', 'ROI.UTM_EPSG',
+                     'PIXEL_SPACING')
 def get_building_percentage(cfg) -> ee.Image:
 
     building_footprints = extract_building_footprints(cfg)
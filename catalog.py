@@ -0,0 +1,166 @@
+import ee
+import json
+import math
+import numpy as np
+import os
+from collections import defaultdict
+
+import ee_cache
+import instrumentation
+import patch_geometry
+import s1
+import s2
+import utils
+
+# scene properties recorded in the catalog besides id, date and footprint
+PROPERTIES = {
+    'sentinel1': {'orbit_pass': 'orbitProperties_pass', 'orbit_number': 'relativeOrbitNumber_start'},
+    'sentinel2': {'cloud': 'CLOUDY_PIXEL_PERCENTAGE', 'orbit_pass': 'SENSING_ORBIT_DIRECTION',
+                  'orbit_number': 'SENSING_ORBIT_NUMBER'}
+}
+ROI_COLLECTIONS = {'sentinel1': s1.roi_collection, 'sentinel2': s2.roi_collection}
+
+
+def _segments_intersect_box(ring: np.ndarray, bounds) -> bool:
+    # whether any edge of the closed ring crosses or lies within the box (vectorized liang-barsky clipping)
+    xmin, ymin, xmax, ymax = bounds
+    start, end = ring[:-1], ring[1:]
+    d = end - start
+    t0 = np.zeros(len(start))
+    t1 = np.ones(len(start))
+    accepted = np.ones(len(start), dtype=bool)
+    for p, q in [(-d[:, 0], start[:, 0] - xmin), (d[:, 0], xmax - start[:, 0]),
+                 (-d[:, 1], start[:, 1] - ymin), (d[:, 1], ymax - start[:, 1])]:
+        parallel = p == 0
+        accepted &= ~(parallel & (q < 0))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            r = q / p
+        t0 = np.where(p < 0, np.maximum(t0, r), t0)
+        t1 = np.where(p > 0, np.minimum(t1, r), t1)
+    return bool(np.any(accepted & (t0 <= t1)))
+
+
+def _contains_point(ring: np.ndarray, x: float, y: float) -> bool:
+    # even-odd rule on the closed ring
+    x0, y0 = ring[:-1, 0], ring[:-1, 1]
+    x1, y1 = ring[1:, 0], ring[1:, 1]
+    crossing = (y0 > y) != (y1 > y)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x_cross = x0 + (y - y0) * (x1 - x0) / (y1 - y0)
+    return bool(np.count_nonzero(crossing & (x < x_cross)) % 2)
+
+
+def intersects(ring: np.ndarray, bounds) -> bool:
+    # whether a footprint ring and a box intersect, both in the same planar crs
+    if _segments_intersect_box(ring, bounds):
+        return True
+    # no edge reaches the box, so it is either completely inside the footprint or outside of it
+    xmin, ymin, xmax, ymax = bounds
+    return _contains_point(ring, (xmin + xmax) / 2, (ymin + ymax) / 2)
+
+
+class SceneCatalog(object):
+    """
+    Metadata of the scenes of a collection over the roi (id, date, footprint, cloud percentage and orbit) with a
+    uniform grid index of the footprints in the utm zone of the roi.
+
+    Patches are resolved to the ids of the scenes whose footprint intersects them locally, in the order of the
+    collection, which is the same set of scenes filterBounds returns on the server.
+    """
+    def __init__(self, cfg, scenes: list, cell_size: float = 10000):
+        self.scenes = scenes
+        self.cell_size = cell_size
+        self._rings = [self._closed(patch_geometry.project(cfg, scene['footprint'])) for scene in scenes]
+        self._cells = defaultdict(list)
+        for i, ring in enumerate(self._rings):
+            for cell in self._cells_of(patch_geometry.polygon_bounds(ring)[0]):
+                self._cells[cell].append(i)
+
+    @staticmethod
+    def _closed(ring: np.ndarray) -> np.ndarray:
+        return ring if np.array_equal(ring[0], ring[-1]) else np.concatenate([ring, ring[:1]])
+
+    def _cells_of(self, bounds) -> list:
+        xmin, ymin, xmax, ymax = [int(math.floor(b / self.cell_size)) for b in bounds]
+        return [(col, row) for col in range(xmin, xmax + 1) for row in range(ymin, ymax + 1)]
+
+    def __len__(self) -> int:
+        return len(self.scenes)
+
+    def query(self, bounds: np.ndarray) -> list:
+        # indices of the scenes intersecting the utm bounds of a patch
+        candidates = set()
+        for cell in self._cells_of(bounds):
+            candidates.update(self._cells.get(cell, []))
+        return [i for i in sorted(candidates) if intersects(self._rings[i], bounds)]
+
+    def patch_scenes(self, bounds: np.ndarray, max_cloud: float = None) -> list:
+        scenes = [self.scenes[i] for i in self.query(bounds)]
+        if max_cloud is not None:
+            # scenes without a cloud percentage are kept, like by filterMetadata('not_greater_than') on the server
+            scenes = [scene for scene in scenes if scene.get('cloud') is None or scene['cloud'] <= max_cloud]
+        return scenes
+
+    def patch_scene_ids(self, bounds: np.ndarray, max_cloud: float = None) -> list:
+        return [scene['id'] for scene in self.patch_scenes(bounds, max_cloud)]
+
+    def save(self, file: str, extent: dict):
+        with open(file, 'w') as f:
+            json.dump(dict(extent, scenes=self.scenes), f)
+
+
+def fetch_scenes(col: ee.ImageCollection, properties: dict) -> list:
+    # one request for the metadata of all scenes of the collection
+    def scene_feature(img):
+        img = ee.Image(img)
+        footprint = ee.Geometry(img.get('system:footprint'))
+        values = {name: img.get(prop) for name, prop in properties.items()}
+        values.update({
+            'id': img.get('system:index'),
+            'date': img.get('system:time_start'),
+            'footprint': footprint.coordinates()
+        })
+        return ee.Feature(None, values)
+
+    features = ee_cache.get_info(ee.FeatureCollection(col.map(scene_feature)))['features']
+    return [feature['properties'] for feature in features]
+
+
+def catalog_file(cfg, sensor: str) -> str:
+    return f'{cfg.PATH}catalog_{sensor}_{cfg.ROI.ID}.json'
+
+
+def catalog_extent(cfg) -> dict:
+    # roi bounds and date range the scenes of a catalog were fetched for
+    return {
+        'lng_range': list(cfg.ROI.LNG_RANGE),
+        'lat_range': list(cfg.ROI.LAT_RANGE),
+        'date_range': list(cfg.SATELLITE_DATA.DATE_RANGE)
+    }
+
+
+@utils.memoize_graph('PATH', 'ROI.ID', 'ROI.LNG_RANGE', 'ROI.LAT_RANGE', 'ROI.UTM_EPSG', 'SATELLITE_DATA.DATE_RANGE',
+                     'DOWNLOAD.CATALOG_CELL_SIZE')
+def load(cfg, sensor: str) -> SceneCatalog:
+    # catalog of the roi, fetched once and stored in PATH for later runs over the same roi bounds and date range
+    file = catalog_file(cfg, sensor)
+    extent = catalog_extent(cfg)
+    scenes = None
+    if os.path.isfile(file):
+        with open(file) as f:
+            stored = json.load(f)
+        if all(stored.get(key) == value for key, value in extent.items()):
+            scenes = stored['scenes']
+
+    with instrumentation.stage('catalog'):
+        if scenes is None:
+            scenes = fetch_scenes(ROI_COLLECTIONS[sensor](cfg), PROPERTIES[sensor])
+        scene_catalog = SceneCatalog(cfg, scenes, cfg.DOWNLOAD.CATALOG_CELL_SIZE)
+    scene_catalog.save(file, extent)
+    return scene_catalog
+
+
+def patch_collection(cfg, sensor: str, bounds: np.ndarray, max_cloud: float = None) -> ee.ImageCollection:
+    # roi collection narrowed down to the explicit scene ids of the patch instead of a server-side spatial filter
+    ids = load(cfg, sensor).patch_scene_ids(bounds, max_cloud)
+    return ROI_COLLECTIONS[sensor](cfg).filter(ee.Filter.inList('system:index', ids))
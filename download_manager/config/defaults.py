@@ -28,10 +28,24 @@ C.ROI.LAT_RANGE = [0, 0]
 
 C.SAMPLING = CN()
 C.SAMPLING.PATCH_SIZE = 256
-C.SAMPLE_FRACTION = 0.3
-C.MAX_SAMPLE_SIZE = 800
-C.NEIGHBORHOOD_SIZE = 50
-C.SEED = 7
+C.SAMPLING.SAMPLE_FRACTION = 0.3
+C.SAMPLING.MAX_SAMPLE_SIZE = 800
+C.SAMPLING.NEIGHBORHOOD_SIZE = 50
+C.SAMPLING.SEED = 7
+C.SAMPLING.LOCAL = False
+C.SAMPLING.ZONE_SCALE = 100
+C.SAMPLING.MIN_SPACING = 0.
+C.SAMPLING.SNAP_TO_GRID = False
+
+C.CACHE = CN()
+C.CACHE.ENABLED = True
+C.CACHE.FILE = ''
+C.CACHE.TTL = 0
+C.CACHE.MAX_ENTRIES = 10000
+
+C.INSTRUMENTATION = CN()
+C.INSTRUMENTATION.ENABLED = True
+C.INSTRUMENTATION.PROFILE = False
 
 C.DOWNLOAD = CN()
 C.DOWNLOAD.TYPE = ''
@@ -39,3 +53,16 @@ C.DOWNLOAD.BUCKET_NAME = 'bucket_name'
 C.DOWNLOAD.DRIVE_FOLDER = 'folder_name'
 C.DOWNLOAD.TABLE_FORMAT = 'GeoJSON'
 C.DOWNLOAD.IMAGE_FORMAT = 'GeoTIFF'
+C.DOWNLOAD.WORKERS = 1
+C.DOWNLOAD.MAX_IN_FLIGHT = 100
+C.DOWNLOAD.POLL_INTERVAL = 10
+C.DOWNLOAD.MAX_POLL_INTERVAL = 120
+C.DOWNLOAD.JOURNAL = True
+C.DOWNLOAD.STACKED = False
+C.DOWNLOAD.EXPORT_MODE = 'patches'
+C.DOWNLOAD.TASK_OVERHEAD = 1.0
+C.DOWNLOAD.CATALOG = False
+C.DOWNLOAD.CATALOG_CELL_SIZE = 10000
+C.DOWNLOAD.S2_FAST_STATS = False
+C.DOWNLOAD.S2_MAX_SCENE_CLOUD = 100
+C.DOWNLOAD.S2_MAX_CLOUD_ERROR = 0.1
@@ -0,0 +1,84 @@
+import ee
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+
+class GetInfoCache(object):
+    """
+    Disk-backed cache of evaluated earth engine expressions, keyed by a hash of the serialized expression.
+
+    Entries older than ttl seconds are re-evaluated (ttl 0 keeps them forever) and the least recently used entries
+    are evicted once more than max_entries are stored.
+    """
+    def __init__(self, file: str, ttl: float = 0, max_entries: int = 10000):
+        self.file = file
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(file, check_same_thread=False)
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT, created REAL, accessed REAL)'
+        )
+        self._connection.commit()
+
+    @staticmethod
+    def key(obj: ee.ComputedObject) -> str:
+        return hashlib.sha256(obj.serialize().encode('utf-8')).hexdigest()
+
+    def get_info(self, obj: ee.ComputedObject, ttl: float = None):
+        ttl = self.ttl if ttl is None else ttl
+        key = self.key(obj)
+        now = time.time()
+
+        with self._lock:
+            row = self._connection.execute('SELECT value, created FROM cache WHERE key = ?', (key,)).fetchone()
+            if row is not None and (not ttl or now - row[1] <= ttl):
+                self._connection.execute('UPDATE cache SET accessed = ? WHERE key = ?', (now, key))
+                self._connection.commit()
+                return json.loads(row[0])
+
+        # evaluating outside of the lock so that concurrent requests are not serialized
+        value = obj.getInfo()
+
+        with self._lock:
+            self._connection.execute('INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)',
+                                     (key, json.dumps(value), now, now))
+            self._evict()
+            self._connection.commit()
+        return value
+
+    def _evict(self):
+        n_entries = self._connection.execute('SELECT COUNT(*) FROM cache').fetchone()[0]
+        if n_entries > self.max_entries:
+            self._connection.execute(
+                'DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY accessed LIMIT ?)',
+                (n_entries - self.max_entries,)
+            )
+
+    def clear(self):
+        with self._lock:
+            self._connection.execute('DELETE FROM cache')
+            self._connection.commit()
+
+
+_cache = None
+
+
+def configure(cfg):
+    # enables the cache for all get_info calls of the run
+    global _cache
+    if cfg.CACHE.ENABLED:
+        file = cfg.CACHE.FILE if cfg.CACHE.FILE else f'{cfg.PATH}getinfo_cache.sqlite'
+        _cache = GetInfoCache(file, ttl=cfg.CACHE.TTL, max_entries=cfg.CACHE.MAX_ENTRIES)
+    else:
+        _cache = None
+
+
+def get_info(obj: ee.ComputedObject, use_cache: bool = True, ttl: float = None):
+    # drop-in replacement for obj.getInfo(), falls back to it if the cache is not configured or use_cache is False
+    if _cache is None or not use_cache:
+        return obj.getInfo()
+    return _cache.get_info(obj, ttl)
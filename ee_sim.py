@@ -0,0 +1,346 @@
+"""
+Local stand-in for the subset of the earth engine python api used by this project.
+
+Objects build a lazy graph exactly like the real client, requests (getInfo, task start and task status) are
+simulated with a configurable latency, random failures and a limit on the number of concurrently running tasks.
+install() registers this module as 'ee' so that the project modules imported afterwards use it instead of the real
+client, e.g. for benchmarks without network access.
+"""
+import itertools
+import json
+import random
+import sys
+import threading
+import time
+
+# simulation parameters, changed with configure()
+_params = {
+    'latency': 0.05,  # seconds per request
+    'jitter': 0.,  # uniformly distributed extra latency in seconds
+    'failure_rate': 0.,  # probability of a request failing and of a task ending up FAILED
+    'max_tasks': 3000,  # maximum number of tasks in the READY or RUNNING state
+    'task_duration': 1.,  # seconds a started task takes to complete
+    'seed': 0
+}
+_random = random.Random(0)
+_lock = threading.Lock()
+_requests = {}
+_tasks = {}
+_task_ids = itertools.count(1)
+
+
+class EEException(Exception):
+    pass
+
+
+def configure(**params):
+    global _random
+    for key, value in params.items():
+        if key not in _params:
+            raise KeyError(f'Unknown simulation parameter {key}')
+        _params[key] = value
+    _random = random.Random(_params['seed'])
+    reset()
+
+
+def reset():
+    with _lock:
+        _requests.clear()
+        _tasks.clear()
+
+
+def stats() -> dict:
+    # number of simulated requests by type
+    with _lock:
+        return dict(_requests)
+
+
+def n_requests() -> int:
+    return sum(stats().values())
+
+
+def _request(kind: str):
+    with _lock:
+        _requests[kind] = _requests.get(kind, 0) + 1
+        delay = _params['latency'] + _random.uniform(0, _params['jitter'])
+        fail = _random.random() < _params['failure_rate']
+    time.sleep(delay)
+    if fail:
+        raise EEException(f'Simulated failure of {kind} request')
+
+
+def install():
+    sys.modules['ee'] = sys.modules[__name__]
+    return sys.modules[__name__]
+
+
+def Initialize(*args, **kwargs):
+    pass
+
+
+def Authenticate(*args, **kwargs):
+    pass
+
+
+# ----- lazy objects -----
+
+# kinds of the objects returned by methods, methods not listed return an object of the same kind
+_RESULT_KINDS = {
+    'Geometry': {'area': 'Number', 'coordinates': 'List', 'contains': 'Object', 'intersects': 'Object'},
+    'Image': {'get': 'Object', 'reduceRegion': 'Dictionary', 'projection': 'Projection', 'bandNames': 'List',
+              'geometry': 'Geometry', 'sampleRectangle': 'Feature', 'stratifiedSample': 'FeatureCollection',
+              'getDownloadURL': None},
+    'ImageCollection': {'mosaic': 'Image', 'mean': 'Image', 'median': 'Image', 'first': 'Image',
+                        'qualityMosaic': 'Image', 'reduce': 'Image', 'max': 'Image', 'min': 'Image',
+                        'size': 'Number', 'toList': 'List', 'aggregate_array': 'List', 'get': 'Object',
+                        'geometry': 'Geometry'},
+    'FeatureCollection': {'reduceToImage': 'Image', 'first': 'Feature', 'size': 'Number', 'toList': 'List',
+                          'aggregate_array': 'List', 'geometry': 'Geometry', 'get': 'Object'},
+    'Feature': {'geometry': 'Geometry', 'get': 'Object'},
+    'List': {'get': 'Object', 'size': 'Number', 'length': 'Number'},
+    'Dictionary': {'get': 'Object', 'keys': 'List', 'values': 'List'},
+    'DateRange': {'start': 'Date', 'end': 'Date'},
+    'Object': {'split': 'List'}
+}
+
+# element kinds handed to the functions mapped over collections and lists
+_ELEMENT_KINDS = {'ImageCollection': 'Image', 'FeatureCollection': 'Feature', 'List': 'Object'}
+
+
+def _encode(value):
+    if isinstance(value, ComputedObject):
+        return value._graph()
+    if isinstance(value, (list, tuple)):
+        return [_encode(v) for v in value]
+    if isinstance(value, dict):
+        return {str(k): _encode(v) for k, v in value.items()}
+    if callable(value):
+        return getattr(value, '__name__', 'function')
+    return value
+
+
+class _Method(object):
+    def __init__(self, obj, name: str):
+        self.obj = obj
+        self.name = name
+
+    def __call__(self, *args, **kwargs):
+        kinds = _RESULT_KINDS.get(self.obj.kind, {})
+        kind = kinds.get(self.name, self.obj.kind)
+        # mapped functions are called on a placeholder, like the real client does to build the graph
+        for arg in list(args) + list(kwargs.values()):
+            if callable(arg) and not isinstance(arg, ComputedObject) and self.name in ('map', 'iterate'):
+                element_kind = _ELEMENT_KINDS.get(self.obj.kind, 'Object')
+                arg(*([ComputedObject(element_kind, 'variable')] * (2 if self.name == 'iterate' else 1)))
+        if kind is None:
+            return 'https://earthengine.example/download'
+        return _new(kind, self.name, self.obj, args, kwargs)
+
+
+class _Meta(type):
+    # class level attributes (e.g. ee.Image.constant) are treated as static functions returning objects of the class
+    def __getattr__(cls, name: str):
+        if name.startswith('__'):
+            raise AttributeError(name)
+
+        def static(*args, **kwargs):
+            return _new(cls.kind if cls.kind != 'Object' else name, name, None, args, kwargs)
+        return static
+
+
+class ComputedObject(object, metaclass=_Meta):
+    kind = 'Object'
+
+    def __init__(self, kind: str = None, func: str = None, receiver=None, args=(), kwargs=None):
+        self.kind = kind if kind is not None else type(self).kind
+        self.func = func
+        self.receiver = receiver
+        self.args = args
+        self.kwargs = kwargs or {}
+
+    def __getattr__(self, name: str):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return _Method(self, name)
+
+    def _graph(self) -> dict:
+        return {
+            'kind': self.kind,
+            'func': self.func,
+            'receiver': _encode(self.receiver),
+            'args': _encode(list(self.args)),
+            'kwargs': _encode(self.kwargs)
+        }
+
+    def serialize(self) -> str:
+        return json.dumps(self._graph(), sort_keys=True, default=str)
+
+    def getInfo(self):
+        _request('getInfo')
+        return _evaluate(self)
+
+
+def _constant(obj):
+    # value of objects constructed directly from a python value, e.g. ee.Number(5)
+    if obj.func is None and obj.receiver is None and len(obj.args) == 1 and not obj.kwargs:
+        value = obj.args[0]
+        if isinstance(value, ComputedObject):
+            return _constant(value)
+        return value
+    return None
+
+
+def _evaluate(obj: ComputedObject):
+    constant = _constant(obj)
+    if constant is not None and not isinstance(constant, ComputedObject):
+        return constant
+    if obj.kind == 'Number':
+        return 100
+    if obj.kind == 'List':
+        return [1, 2]
+    if obj.kind == 'Dictionary':
+        return {}
+    if obj.kind == 'Geometry':
+        return {'type': 'Polygon', 'coordinates': [[[0, 0], [1, 0], [1, 1], [0, 1], [0, 0]]]}
+    if obj.kind in ('Image', 'ImageCollection', 'Feature', 'FeatureCollection'):
+        return {'type': obj.kind, 'bands': [], 'features': [], 'properties': {}}
+    return 'object'
+
+
+def _new(kind: str, func: str, receiver, args, kwargs) -> ComputedObject:
+    cls = _CLASSES.get(kind, ComputedObject)
+    return cls(kind, func, receiver, args, kwargs)
+
+
+def _kind_class(name: str):
+    def __init__(self, *args, **kwargs):
+        # constructors receive python values or other objects, internal construction passes the graph node fields
+        if args and args[0] == name and len(args) == 5:
+            ComputedObject.__init__(self, *args)
+        else:
+            ComputedObject.__init__(self, name, None, None, args, kwargs)
+    return _Meta(name, (ComputedObject,), {'kind': name, '__init__': __init__})
+
+
+Number = _kind_class('Number')
+String = _kind_class('String')
+List = _kind_class('List')
+Dictionary = _kind_class('Dictionary')
+Date = _kind_class('Date')
+DateRange = _kind_class('DateRange')
+Geometry = _kind_class('Geometry')
+Feature = _kind_class('Feature')
+FeatureCollection = _kind_class('FeatureCollection')
+Image = _kind_class('Image')
+ImageCollection = _kind_class('ImageCollection')
+Reducer = _kind_class('Reducer')
+Kernel = _kind_class('Kernel')
+Filter = _kind_class('Filter')
+Join = _kind_class('Join')
+Projection = _kind_class('Projection')
+ErrorMargin = _kind_class('ErrorMargin')
+
+_CLASSES = {cls.kind: cls for cls in [Number, String, List, Dictionary, Date, DateRange, Geometry, Feature,
+                                      FeatureCollection, Image, ImageCollection, Reducer, Kernel, Filter, Join,
+                                      Projection, ErrorMargin]}
+
+
+class _Namespace(object):
+    # ee.Algorithms and similar namespaces of functions returning objects of a fixed kind
+    def __init__(self, kinds: dict, default: str = 'Object'):
+        self._kinds = kinds
+        self._default = default
+
+    def __getattr__(self, name: str):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        if name in self._kinds and isinstance(self._kinds[name], _Namespace):
+            return self._kinds[name]
+
+        def function(*args, **kwargs):
+            return _new(self._kinds.get(name, self._default), name, None, args, kwargs)
+        return function
+
+
+Algorithms = _Namespace({'GeometryConstructors': _Namespace({}, default='Geometry')})
+
+
+# ----- batch -----
+
+class Task(object):
+
+    def __init__(self, task_id=None, task_type: str = 'EXPORT_IMAGE', state: str = 'UNSUBMITTED', config=None,
+                 name=None):
+        self.id = task_id
+        self.task_type = task_type
+        self.state = state
+        self.config = config
+
+    def start(self):
+        _request('start')
+        with _lock:
+            active = sum(1 for task in _tasks.values() if _task_state(task) in ('READY', 'RUNNING'))
+            if active >= _params['max_tasks']:
+                raise EEException('Too many tasks already in the queue')
+            if self.id is None:
+                self.id = f'SIMULATED{next(_task_ids):012d}'
+            _tasks[self.id] = {'started': time.time(), 'failed': _random.random() < _params['failure_rate']}
+
+    def status(self) -> dict:
+        return data.getTaskStatus(self.id)[0]
+
+    def active(self) -> bool:
+        return self.status()['state'] in ('READY', 'RUNNING')
+
+
+def _task_state(task: dict) -> str:
+    if task is None:
+        return 'UNKNOWN'
+    elapsed = time.time() - task['started']
+    if elapsed < _params['task_duration'] / 10:
+        return 'READY'
+    if elapsed < _params['task_duration']:
+        return 'RUNNING'
+    return 'FAILED' if task['failed'] else 'COMPLETED'
+
+
+class _Data(object):
+
+    @staticmethod
+    def getTaskStatus(task_ids) -> list:
+        _request('status')
+        if isinstance(task_ids, str):
+            task_ids = [task_ids]
+        with _lock:
+            return [{'id': task_id, 'state': _task_state(_tasks.get(task_id))} for task_id in task_ids]
+
+    @staticmethod
+    def newTaskId(count: int = 1) -> list:
+        return [f'SIMULATED{next(_task_ids):012d}' for _ in range(count)]
+
+
+data = _Data()
+
+
+def _export(**kwargs) -> Task:
+    # task definitions are built client-side, no request is made before the task is started
+    return Task(config=_encode(kwargs))
+
+
+class _ExportTarget(object):
+    toDrive = staticmethod(_export)
+    toCloudStorage = staticmethod(_export)
+    toAsset = staticmethod(_export)
+
+
+class _Export(object):
+    image = _ExportTarget()
+    table = _ExportTarget()
+
+
+class _Batch(object):
+    Task = Task
+    Export = _Export()
+
+
+batch = _Batch()
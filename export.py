@@ -1,4 +1,6 @@
 import ee
+import ee_cache
+import json
 import utils
 
 
@@ -42,7 +44,7 @@ def image_to_drive(img: ee.Image, roi: ee.Geometry, folder: str, file_name: str,
     if patch_size == -1:
         task = ee.batch.Export.image.toDrive(
             image=img,
-            region=roi.getInfo()['coordinates'],
+            region=ee_cache.get_info(roi)['coordinates'],
             description='PythonToDriveExport',
             folder=folder,
             fileNamePrefix=file_name,
@@ -54,7 +56,7 @@ def image_to_drive(img: ee.Image, roi: ee.Geometry, folder: str, file_name: str,
     else:
         task = ee.batch.Export.image.toDrive(
             image=img,
-            region=roi.getInfo()['coordinates'],
+            region=ee_cache.get_info(roi)['coordinates'],
             description='PythonToDriveExport',
             folder=folder,
             fileNamePrefix=file_name,
@@ -73,7 +75,7 @@ def image_to_cloud(img: ee.Image, bbox: ee.Geometry, bucket: str, folder: str, f
     if patch_size == -1:
         task = ee.batch.Export.image.toCloudStorage(
             image=img,
-            region=bbox.getInfo()['coordinates'],
+            region=ee_cache.get_info(bbox)['coordinates'],
             description='PythonToCloudExport',
             bucket=bucket,
             fileNamePrefix= f'{folder}/{file_name}',
@@ -85,7 +87,7 @@ def image_to_cloud(img: ee.Image, bbox: ee.Geometry, bucket: str, folder: str, f
     else:
         task = ee.batch.Export.image.toCloudStorage(
             image=img,
-            region=bbox.getInfo()['coordinates'],
+            region=ee_cache.get_info(bbox)['coordinates'],
             description='PythonToCloudExport',
             bucket=bucket,
             fileNamePrefix= f'{folder}/{file_name}_',
@@ -96,3 +98,98 @@ def image_to_cloud(img: ee.Image, bbox: ee.Geometry, bucket: str, folder: str, f
             fileFormat='GeoTIFF'
         )
     return task
+
+
+# config entries besides the date range and the patch grid that change the pixels of a snapped patch export
+PROCESSING_KEYS = ['SATELLITE_DATA.RECORDS', 'BUILDING_FOOTPRINTS.ASSETS', 'BUILDING_FOOTPRINTS.PIXEL_PERCENTAGE',
+                   'DOWNLOAD.CATALOG', 'DOWNLOAD.S2_FAST_STATS', 'DOWNLOAD.S2_MAX_SCENE_CLOUD',
+                   'DOWNLOAD.S2_MAX_CLOUD_ERROR']
+
+
+def processing_id(cfg) -> str:
+    # date range and hash of the processing parameters, shared by all rois processed with the same parameters
+    start, end = cfg.SATELLITE_DATA.DATE_RANGE
+    return f'{start}_{end}_{utils.config_hash(cfg, PROCESSING_KEYS)}'
+
+
+def patch_file_name(cfg, sensor: str, i) -> str:
+    # i is the grid id of snapped patches (see patch_geometry.patch_id), their names do not depend on the roi but on
+    # the date range and processing parameters so that exports are shared by all runs over the same patch, dates and
+    # parameters
+    if cfg.SAMPLING.SNAP_TO_GRID:
+        return f'{sensor}_{processing_id(cfg)}_{i}'
+    return f'{sensor}_{cfg.ROI.ID}_patch{i + 1}'
+
+
+def patch_dir(cfg) -> str:
+    return 'grid' if cfg.SAMPLING.SNAP_TO_GRID else cfg.ROI.ID
+
+
+def patch_prefix(cfg, sensor: str, i) -> str:
+    return f'{patch_dir(cfg)}/{sensor}/{patch_file_name(cfg, sensor, i)}'
+
+
+def patch_to_cloud(cfg, img: ee.Image, region: ee.Geometry, sensor: str, i):
+    # snapped patches are exported on the global pixel grid of the utm zone, so that their pixels are identical
+    # across runs
+    if cfg.SAMPLING.SNAP_TO_GRID:
+        grid = {'crsTransform': [cfg.PIXEL_SPACING, 0, 0, 0, -cfg.PIXEL_SPACING, 0]}
+    else:
+        grid = {'scale': cfg.PIXEL_SPACING}
+    task = ee.batch.Export.image.toCloudStorage(
+        image=img,
+        region=region,
+        description='PythonToCloudExport',
+        bucket=cfg.DOWNLOAD.BUCKET_NAME,
+        fileNamePrefix=patch_prefix(cfg, sensor, i),
+        crs=cfg.ROI.UTM_EPSG,
+        maxPixels=1e6,
+        fileFormat='GeoTIFF',
+        **grid
+    )
+    return task
+
+
+def roi_file_name(cfg, sensor: str) -> str:
+    return f'{sensor}_{cfg.ROI.ID}_tile'
+
+
+def grid_to_cloud(cfg, img: ee.Image, region: ee.Geometry, sensor: str, crs_transform: list):
+    # sharded export of the whole roi, each shard is a patch of the grid given by crs_transform
+    task = ee.batch.Export.image.toCloudStorage(
+        image=img,
+        region=region,
+        description='PythonToCloudExport',
+        bucket=cfg.DOWNLOAD.BUCKET_NAME,
+        fileNamePrefix=f'{cfg.ROI.ID}/{sensor}/{roi_file_name(cfg, sensor)}',
+        crs=cfg.ROI.UTM_EPSG,
+        crsTransform=crs_transform,
+        maxPixels=1e10,
+        fileDimensions=cfg.SAMPLING.PATCH_SIZE,
+        fileFormat='GeoTIFF'
+    )
+    return task
+
+
+def build_manifest(bands: dict) -> dict:
+    # bands of each sensor in stacking order, the manifest stores the band range [start, stop) of each sensor
+    manifest = {'bands': [], 'sensors': {}}
+    for sensor, sensor_bands in bands.items():
+        start = len(manifest['bands'])
+        manifest['bands'].extend(sensor_bands)
+        manifest['sensors'][sensor] = [start, start + len(sensor_bands)]
+    return manifest
+
+
+def manifest_file(cfg) -> str:
+    return f'{cfg.PATH}manifest_{cfg.ROI.ID}.json'
+
+
+def write_manifest(cfg, manifest: dict):
+    with open(manifest_file(cfg), 'w') as f:
+        json.dump(manifest, f, indent=4)
+
+
+def load_manifest(cfg) -> dict:
+    with open(manifest_file(cfg)) as f:
+        return json.load(f)
@@ -1,16 +1,32 @@
 import ee
-import json
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, as_completed, wait
 
 from download_manager import args
 from download_manager.config import config
 
 import satellite_data
 import building_footprints
+import catalog
+import ee_cache
+import instrumentation
 import export
 import sampling
 import utils
 import s1
 import s2
+import patch_geometry
+import scheduler
+import journal
+import points
+import tiling
+
+SENSORS = ['sentinel1', 'sentinel2', 'buildings']
+BANDS = {
+    'sentinel1': ['VV', 'VH'],
+    'sentinel2': ['B2', 'B3', 'B4', 'B8', 'B11', 'B12'],
+    'buildings': ['buildingPercentage']
+}
 
 
 def setup(args):
@@ -21,6 +37,153 @@ def setup(args):
     return cfg
 
 
+def s2_params(cfg) -> dict:
+    return {
+        'fast': cfg.DOWNLOAD.S2_FAST_STATS,
+        'max_scene_cloud': cfg.DOWNLOAD.S2_MAX_SCENE_CLOUD,
+        'max_cloud_error': cfg.DOWNLOAD.S2_MAX_CLOUD_ERROR
+    }
+
+
+def scene_collection(cfg, sensor: str, bounds: np.ndarray = None) -> ee.ImageCollection:
+    # with the catalog the patch scenes are resolved locally, otherwise the roi collection is filtered per patch
+    if cfg.DOWNLOAD.CATALOG and bounds is not None:
+        max_cloud = None
+        if sensor == 'sentinel2' and cfg.DOWNLOAD.S2_FAST_STATS:
+            max_cloud = cfg.DOWNLOAD.S2_MAX_SCENE_CLOUD
+        return catalog.patch_collection(cfg, sensor, bounds, max_cloud)
+    if sensor == 'sentinel1':
+        return s1.roi_collection(cfg)
+    return s2.roi_collection(cfg)
+
+
+def patch_image(cfg, sensor: str, patch: ee.Geometry, date_range, bounds: np.ndarray = None) -> ee.Image:
+    # roi-level graphs are memoized, only the per-patch part is built for each patch. Collections resolved by the
+    # catalog only hold the scenes of the patch and are not filtered by its bounds again
+    filter_bounds = not (cfg.DOWNLOAD.CATALOG and bounds is not None)
+    if sensor == 'sentinel1':
+        return s1.single_orbit_mean(patch, date_range, scene_collection(cfg, sensor, bounds), filter_bounds)
+    if sensor == 'sentinel2':
+        return s2.cloud_free_mosaic(patch, date_range, scene_collection(cfg, sensor, bounds), **s2_params(cfg),
+                                    filter_bounds=filter_bounds)
+    if sensor == 'buildings':
+        return building_footprints.get_building_percentage(cfg).clip(patch)
+    if sensor == 'stacked':
+        # all sensors as one image, the band order is recorded in the manifest of the roi
+        images = [patch_image(cfg, s, patch, date_range, bounds).select(BANDS[s]) for s in SENSORS]
+        return ee.Image.cat(images).float()
+
+
+def export_sensors(cfg) -> list:
+    return ['stacked'] if cfg.DOWNLOAD.STACKED else SENSORS
+
+
+def patch_tasks(cfg, bounds: np.ndarray, i, date_range, sensors: list = SENSORS) -> dict:
+
+    # the patch is built client-side from its precomputed utm bounds, no request is made before the task starts
+    patch = patch_geometry.bounds_to_geometry(cfg, bounds)
+
+    tasks = {}
+    for sensor in sensors:
+        with instrumentation.stage('graph'):
+            img = patch_image(cfg, sensor, patch, date_range, bounds)
+        with instrumentation.stage('task'):
+            tasks[sensor] = export.patch_to_cloud(cfg, img, patch, sensor, i)
+
+    return tasks
+
+
+def submit_patch(cfg, bounds: np.ndarray, i: int, date_range, export_scheduler: scheduler.ExportScheduler,
+                 export_journal: journal.ExportJournal = None) -> int:
+    print(i)
+
+    # skipping exports that were completed in a previous run or re-attached to the scheduler, snapped patches are
+    # identified by their grid id so that exports of other runs over the same patch are skipped as well
+    patch = patch_geometry.patch_id(cfg, bounds, i)
+    sensors = export_sensors(cfg)
+    if export_journal is not None:
+        sensors = [sensor for sensor in sensors
+                   if not export_journal.is_completed(sensor, patch) and not export_journal.is_active(sensor, patch)]
+    if not sensors:
+        return i
+
+    with instrumentation.stage('submit'):
+        tasks = patch_tasks(cfg, bounds, patch, date_range, sensors)
+        # patches are released in sampling order, the scheduler starts them once the in-flight window allows it
+        for sensor, task in tasks.items():
+            key = (sensor, patch, export.patch_file_name(cfg, sensor, patch))
+            export_scheduler.submit(task, priority=i, key=key)
+    return i
+
+
+def submit_patches(cfg, patches, date_range, export_scheduler: scheduler.ExportScheduler,
+                   export_journal: journal.ExportJournal = None) -> int:
+    # patches can be any iterable of patch bounds, they are consumed lazily so that exports start right away
+    # serial submission unless more than one worker is configured
+    n_workers = cfg.DOWNLOAD.WORKERS
+    n_patches = 0
+    if n_workers <= 1:
+        for i, bounds in enumerate(patches):
+            submit_patch(cfg, bounds, i, date_range, export_scheduler, export_journal)
+            n_patches += 1
+        return n_patches
+
+    # preparing patch exports concurrently, the getInfo round trips dominate so threads suffice
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        pending = set()
+        for i, bounds in enumerate(patches):
+            # bounding the number of pending patches to not read ahead the whole points file
+            if len(pending) >= 4 * n_workers:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    future.result()
+            pending.add(executor.submit(submit_patch, cfg, bounds, i, date_range, export_scheduler, export_journal))
+            n_patches += 1
+        for future in as_completed(pending):
+            future.result()
+    return n_patches
+
+
+def submit_roi(cfg, patches: np.ndarray, date_range, export_scheduler: scheduler.ExportScheduler,
+               export_journal: journal.ExportJournal = None):
+    # one export of the whole roi per sensor, sharded into patch-size tiles that are mapped to the sampled patches.
+    # The images are built for the roi as a single patch, so the sentinel-2 best and best_local scenes have to be
+    # cloud free over the whole roi rather than over each patch. Patches therefore mostly get the quality mosaic and
+    # can differ from their per-patch exports
+    grid = tiling.roi_grid(cfg)
+    tiling.write_index(cfg, tiling.build_index(grid, patches))
+    region = tiling.grid_geometry(cfg, grid)
+
+    patch = tiling.roi_patch_id(cfg)
+    for sensor in export_sensors(cfg):
+        if export_journal is not None and (export_journal.is_completed(sensor, patch)
+                                           or export_journal.is_active(sensor, patch)):
+            continue
+        img = patch_image(cfg, sensor, region, date_range)
+        task = export.grid_to_cloud(cfg, img, region, sensor, tiling.crs_transform(grid))
+        key = (sensor, patch, export.roi_file_name(cfg, sensor))
+        export_scheduler.submit(task, key=key)
+
+
+def submit(cfg, date_range, export_scheduler: scheduler.ExportScheduler,
+           export_journal: journal.ExportJournal = None):
+    # streaming the sampled points, patch bounds are computed in vectorized chunks while reading
+    features = points.iter_sampled_features(points.points_files(cfg))
+    patches = patch_geometry.iter_bounds(cfg, features)
+
+    # planning the export mode requires all patches, otherwise they are streamed into the submission
+    export_mode = 'patches'
+    if cfg.DOWNLOAD.EXPORT_MODE != 'patches':
+        patches = np.array(list(patches)).reshape(-1, 4)
+        export_mode = tiling.plan(cfg, patches)
+
+    if export_mode == 'tiled':
+        submit_roi(cfg, patches, date_range, export_scheduler, export_journal)
+    else:
+        n_patches = submit_patches(cfg, patches, date_range, export_scheduler, export_journal)
+        print(f'Submitted {n_patches} patches')
+
+
 if __name__ == '__main__':
     # setting up config based on parsed argument
     parser = args.argument_parser()
@@ -28,111 +191,39 @@ if __name__ == '__main__':
     cfg = setup(args)
 
     ee.Initialize()
+    ee_cache.configure(cfg)
+    instrumentation.configure(cfg)
 
     roi = utils.extract_bbox(cfg)
     date_range = utils.extract_date_range(cfg)
 
-    with open(f'{cfg.PATH}points_{cfg.ROI.ID}.geojson') as f:
-        features = json.load(f)['features']
-
-    features = [feature for feature in features if feature.get('properties').get('densityZone') != 0]
-    print(len(features))
-
-    for i, feature in enumerate(features):
-        print(i)
-        coords = feature['geometry']['coordinates']
-        point = ee.Geometry.Point(coords)
-
-        patch_size = ee.Number(cfg.SAMPLING.PATCH_SIZE)
-        pixel_spacing = ee.Number(cfg.PIXEL_SPACING)
-        crsUTM = cfg.ROI.UTM_EPSG
-        crsWGS84 = 'EPSG:4326'
-
-        point = point.transform(crsUTM)
-        buffer_distance = patch_size.divide(2).multiply(pixel_spacing)
-        patch = point.buffer(distance=buffer_distance, proj=crsUTM).bounds(proj=crsUTM)
-        patch = patch.transform(crsWGS84, 0.001)
-
-        s1mean = s1.single_orbit_mean(patch, date_range)
-        s1task = ee.batch.Export.image.toCloudStorage(
-            image=s1mean,
-            region=patch.getInfo()['coordinates'],
-            description='PythonToCloudExport',
-            bucket=cfg.DOWNLOAD.BUCKET_NAME,
-            fileNamePrefix=f'{cfg.ROI.ID}/sentinel1/sentinel1_{cfg.ROI.ID}_patch{i + 1}',
-            scale=cfg.PIXEL_SPACING,
-            crs=cfg.ROI.UTM_EPSG,
-            maxPixels=1e6,
-            fileFormat='GeoTIFF'
-        )
-
-        # s1task = ee.batch.Export.image.toDrive(
-        #     image=s1mean,
-        #     region=patch.getInfo()['coordinates'],
-        #     description='PythonToDriveExport',
-        #     folder=cfg.DOWNLOAD.DRIVE_FOLDER,
-        #     fileNamePrefix=f'sentinel1_{cfg.ROI.ID}_patch{i + 1}',
-        #     scale=cfg.PIXEL_SPACING,
-        #     crs=cfg.ROI.UTM_EPSG,
-        #     maxPixels=1e6,
-        #     fileFormat='GeoTIFF'
-        # )
-
-        s2mosaic = s2.cloud_free_mosaic(patch, date_range)
-        s2task = ee.batch.Export.image.toCloudStorage(
-            image=s2mosaic,
-            region=patch.getInfo()['coordinates'],
-            description='PythonToCloudExport',
-            bucket=cfg.DOWNLOAD.BUCKET_NAME,
-            fileNamePrefix=f'{cfg.ROI.ID}/sentinel2/sentinel2_{cfg.ROI.ID}_patch{i + 1}',
-            scale=cfg.PIXEL_SPACING,
-            crs=cfg.ROI.UTM_EPSG,
-            maxPixels=1e6,
-            fileFormat='GeoTIFF'
-        )
-
-        # s2task = ee.batch.Export.image.toDrive(
-        #     image=s2mosaic,
-        #     region=patch.getInfo()['coordinates'],
-        #     description='PythonToDriveExport',
-        #     folder=cfg.DOWNLOAD.DRIVE_FOLDER,
-        #     fileNamePrefix=f'sentinel2_{cfg.ROI.ID}_patch{i + 1}',
-        #     scale=cfg.PIXEL_SPACING,
-        #     crs=cfg.ROI.UTM_EPSG,
-        #     maxPixels=1e6,
-        #     fileFormat='GeoTIFF'
-        # )
-
-        label = building_footprints.get_building_percentage(cfg)
-        btask = ee.batch.Export.image.toCloudStorage(
-            image=label,
-            region=patch.getInfo()['coordinates'],
-            description='PythonToCloudExport',
-            bucket=cfg.DOWNLOAD.BUCKET_NAME,
-            fileNamePrefix=f'{cfg.ROI.ID}/buildings/buildings_{cfg.ROI.ID}_patch{i + 1}',
-            scale=cfg.PIXEL_SPACING,
-            crs=cfg.ROI.UTM_EPSG,
-            maxPixels=1e6,
-            fileFormat='GeoTIFF'
-        )
-
-        # btask = ee.batch.Export.image.toDrive(
-        #     image=label,
-        #     region=patch.getInfo()['coordinates'],
-        #     description='PythonToDriveExport',
-        #     folder=cfg.DOWNLOAD.DRIVE_FOLDER,
-        #     fileNamePrefix=f'buildings_{cfg.ROI.ID}_patch{i + 1}',
-        #     scale=cfg.PIXEL_SPACING,
-        #     crs=cfg.ROI.UTM_EPSG,
-        #     maxPixels=1e6,
-        #     fileFormat='GeoTIFF'
-        # )
-
-        s1task.start()
-        s2task.start()
-        btask.start()
-
-
-
-
-
+    if cfg.DOWNLOAD.STACKED:
+        export.write_manifest(cfg, export.build_manifest({sensor: BANDS[sensor] for sensor in SENSORS}))
+
+    # the journal allows reruns to resume from where a previous run stopped
+    export_journal = None
+    on_state_change = None
+    if cfg.DOWNLOAD.JOURNAL:
+        export_journal = journal.from_config(cfg)
+        on_state_change = export_journal.record
+
+    export_scheduler = scheduler.from_config(cfg, on_state_change)
+    reattached = []
+    if export_journal is not None:
+        reattached = export_journal.reattach(export_scheduler)
+        print(f'Re-attached {len(reattached)} running tasks')
+    export_scheduler.start()
+    submit(cfg, date_range, export_scheduler, export_journal)
+    export_scheduler.join()
+
+    # re-attached tasks were skipped by the submission, those that did not complete are exported again in a second
+    # pass, which also retries the exports that failed in this run
+    n_failed = sum(1 for sensor, i in reattached if not export_journal.is_completed(sensor, i))
+    if n_failed > 0:
+        print(f'Resubmitting {n_failed} re-attached tasks that did not complete')
+        export_scheduler = scheduler.from_config(cfg, on_state_change)
+        export_scheduler.start()
+        submit(cfg, date_range, export_scheduler, export_journal)
+        export_scheduler.join()
+
+    instrumentation.write_summary(cfg)
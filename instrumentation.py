@@ -0,0 +1,182 @@
+import cProfile
+import ee
+import io
+import json
+import math
+import pstats
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+# upper bounds of the latency histogram buckets in seconds
+BUCKETS = [0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, math.inf]
+
+
+class Metric(object):
+    def __init__(self):
+        self.count = 0
+        self.total = 0.
+        self.min = math.inf
+        self.max = 0.
+        self.buckets = [0] * len(BUCKETS)
+
+    def observe(self, seconds: float):
+        self.count += 1
+        self.total += seconds
+        self.min = min(self.min, seconds)
+        self.max = max(self.max, seconds)
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                self.buckets[i] += 1
+                break
+
+    def to_dict(self) -> dict:
+        return {
+            'count': self.count,
+            'total': self.total,
+            'mean': self.total / self.count if self.count else 0,
+            'min': self.min if self.count else 0,
+            'max': self.max,
+            'histogram': {str(bound): n for bound, n in zip(BUCKETS, self.buckets)}
+        }
+
+
+_metrics = {}
+_profiles = {}
+_lock = threading.Lock()
+# profilers of the stages each thread is in, innermost last, None for stages that are not profiled
+_stack = threading.local()
+_installed = False
+_profile_stages = False
+
+
+def observe(name: str, seconds: float):
+    with _lock:
+        if name not in _metrics:
+            _metrics[name] = Metric()
+        _metrics[name].observe(seconds)
+
+
+@contextmanager
+def timed(name: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start)
+
+
+def _profilers() -> list:
+    if not hasattr(_stack, 'profilers'):
+        _stack.profilers = []
+    return _stack.profilers
+
+
+@contextmanager
+def stage(name: str, profile: bool = None):
+    # times a pipeline stage, optionally capturing a cProfile of it. Profiles are tracked per thread and stage, a
+    # nested profiled stage pauses the profile of the enclosing one, so each profile only holds the calls outside of
+    # its profiled sub-stages. Stages whose profiler cannot be enabled (another profiling tool is active, e.g. in
+    # another thread from python 3.12 on) are timed only
+    profile = _profile_stages if profile is None else profile
+    profilers = _profilers()
+    outer = next((p for p in reversed(profilers) if p is not None), None)
+    profiler = None
+    if profile:
+        if outer is not None:
+            outer.disable()
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            profiler = None
+            if outer is not None:
+                outer.enable()
+    profilers.append(profiler)
+    try:
+        with timed(f'stage_{name}'):
+            yield
+    finally:
+        profilers.pop()
+        if profiler is not None:
+            profiler.disable()
+            with _lock:
+                if name in _profiles:
+                    _profiles[name].add(profiler)
+                else:
+                    _profiles[name] = pstats.Stats(profiler)
+            if outer is not None:
+                outer.enable()
+
+
+def _wrap(func: callable, name: str) -> callable:
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        with timed(name):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def instrument_ee():
+    # times every getInfo, task start and task status request of the ee client
+    global _installed
+    if _installed:
+        return
+    ee.ComputedObject.getInfo = _wrap(ee.ComputedObject.getInfo, 'ee_getinfo')
+    ee.batch.Task.start = _wrap(ee.batch.Task.start, 'ee_task_start')
+    ee.batch.Task.status = _wrap(ee.batch.Task.status, 'ee_task_status')
+    ee.data.getTaskStatus = _wrap(ee.data.getTaskStatus, 'ee_task_status')
+    _installed = True
+
+
+def configure(cfg):
+    global _profile_stages
+    _profile_stages = cfg.INSTRUMENTATION.PROFILE
+    if cfg.INSTRUMENTATION.ENABLED:
+        instrument_ee()
+
+
+def summary() -> dict:
+    with _lock:
+        return {name: metric.to_dict() for name, metric in sorted(_metrics.items())}
+
+
+def to_prometheus() -> str:
+    lines = []
+    for name, metric in summary().items():
+        metric_name = f'gee_download_{name}_seconds'
+        lines.append(f'# TYPE {metric_name} histogram')
+        cumulative = 0
+        for bound, n in zip(BUCKETS, metric['histogram'].values()):
+            cumulative += n
+            le = '+Inf' if bound == math.inf else str(bound)
+            lines.append(f'{metric_name}_bucket{{le="{le}"}} {cumulative}')
+        lines.append(f'{metric_name}_sum {metric["total"]}')
+        lines.append(f'{metric_name}_count {metric["count"]}')
+    return '\n'.join(lines) + '\n'
+
+
+def profile_report(n_lines: int = 30) -> str:
+    report = io.StringIO()
+    with _lock:
+        for name, stats in _profiles.items():
+            report.write(f'===== stage {name} =====\n')
+            stats.stream = report
+            stats.sort_stats('cumulative').print_stats(n_lines)
+    return report.getvalue()
+
+
+def write_summary(cfg):
+    # writes the summary of the run as json and in the prometheus text format to PATH
+    prefix = f'{cfg.PATH}metrics_{cfg.ROI.ID}'
+    with open(f'{prefix}.json', 'w') as f:
+        json.dump(summary(), f, indent=4)
+    with open(f'{prefix}.prom', 'w') as f:
+        f.write(to_prometheus())
+    if _profiles:
+        with open(f'{prefix}_profile.txt', 'w') as f:
+            f.write(profile_report())
+
+    for name, metric in summary().items():
+        print(f'{name}: {metric["count"]} calls, {metric["total"]:.2f}s total, {metric["mean"]:.3f}s mean')
@@ -0,0 +1,85 @@
+import ee
+import json
+import os
+import threading
+import time
+
+import export
+import scheduler
+
+# states of tasks that are still processed by earth engine and can be re-attached after a restart
+ACTIVE_STATES = ['READY', 'RUNNING']
+
+
+class ExportJournal(object):
+    """
+    Append-only on-disk log of the patch exports of a run, one json line per state change of a patch/sensor export.
+
+    The last line of an export wins, so a rerun can skip completed exports, re-attach to the ones still running and
+    resubmit the failed ones.
+    """
+    def __init__(self, file: str):
+        self.file = file
+        self._records = {}
+        self._lock = threading.Lock()
+
+        if os.path.isfile(file):
+            with open(file) as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    record = json.loads(line)
+                    self._records[(record['sensor'], record['patch'])] = record
+
+    def get(self, sensor: str, i) -> dict:
+        return self._records.get((sensor, i))
+
+    def state(self, sensor: str, i) -> str:
+        record = self.get(sensor, i)
+        return None if record is None else record['state']
+
+    def is_completed(self, sensor: str, i) -> bool:
+        return self.state(sensor, i) == 'COMPLETED'
+
+    def is_active(self, sensor: str, i) -> bool:
+        return self.state(sensor, i) in ACTIVE_STATES
+
+    def record(self, key: tuple, task: ee.batch.Task, state: str):
+        # matches the on_state_change signature of the scheduler, key being (sensor, patch index, prefix)
+        sensor, i, prefix = key
+        record = {'sensor': sensor, 'patch': i, 'prefix': prefix, 'task_id': task.id, 'state': state,
+                  'time': time.time()}
+        with self._lock:
+            self._records[(sensor, i)] = record
+            with open(self.file, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+
+    def reattach(self, export_scheduler: scheduler.ExportScheduler) -> list:
+        # handing tasks that were still running when the previous run stopped back to the scheduler, their states are
+        # polled first so that tasks which finished in the meantime are recorded and ids the backend no longer knows
+        # (reported as UNKNOWN or missing) are left to be resubmitted, returns the (sensor, patch) keys re-attached
+        active = {record['task_id']: key for key, record in self._records.items() if record['state'] in ACTIVE_STATES}
+        if not active:
+            return []
+        states = {status['id']: status['state'] for status in ee.data.getTaskStatus(list(active.keys()))}
+
+        reattached = []
+        for task_id, (sensor, i) in active.items():
+            record = self._records[(sensor, i)]
+            state = states.get(task_id, 'UNKNOWN')
+            task = ee.batch.Task(task_id, 'EXPORT_IMAGE', state)
+            key = (sensor, i, record['prefix'])
+            if state != record['state']:
+                self.record(key, task, state)
+            if state in ACTIVE_STATES:
+                export_scheduler.attach(task, key=key)
+                reattached.append((sensor, i))
+        return reattached
+
+
+def from_config(cfg) -> ExportJournal:
+    # exports of snapped patches are shared by all rois over the same date range and processing parameters
+    if cfg.SAMPLING.SNAP_TO_GRID:
+        return ExportJournal(f'{cfg.PATH}journal_grid_{export.processing_id(cfg)}.jsonl')
+    return ExportJournal(f'{cfg.PATH}journal_{cfg.ROI.ID}.jsonl')
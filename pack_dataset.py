@@ -0,0 +1,62 @@
+from pathlib import Path
+
+import rasterio
+from rasterio.windows import Window
+
+from download_manager import args
+from download_manager.config import config
+
+import export
+import gee_download
+import patch_geometry
+import points
+from patch_store import PatchStore
+
+
+def setup(args):
+    cfg = config.new_config()
+    cfg.merge_from_file(f'configs/{args.config_file}.yaml')
+    cfg.merge_from_list(args.opts)
+    cfg.NAME = args.config_file
+    return cfg
+
+
+def read_patch(file: Path, size: int) -> tuple:
+    # patch of size x size pixels starting at the upper left corner, exports a pixel short are padded with zeros
+    with rasterio.open(file) as src:
+        arr = src.read(window=Window(0, 0, size, size), boundless=True, fill_value=0)
+        return arr, tuple(src.transform)[:6]
+
+
+def iter_city_patches(cfg):
+    # downloaded patches of the roi for which the exports of all sensors exist, with their density zone
+    size = cfg.SAMPLING.PATCH_SIZE
+    features = points.iter_sampled_features(points.points_files(cfg))
+    for i, feature in enumerate(features):
+        patch = patch_geometry.patch_id(cfg, patch_geometry.features_to_bounds(cfg, [feature])[0], i)
+        files = {sensor: Path(f'{cfg.PATH}{export.patch_prefix(cfg, sensor, patch)}.tif')
+                 for sensor in gee_download.SENSORS}
+        if not all(file.is_file() for file in files.values()):
+            continue
+        arrays = {}
+        for sensor, file in files.items():
+            arrays[sensor], transform = read_patch(file, size)
+        yield patch if cfg.SAMPLING.SNAP_TO_GRID else i + 1, arrays, transform, feature['properties']['densityZone']
+
+
+def modalities(cfg) -> dict:
+    size = cfg.SAMPLING.PATCH_SIZE
+    return {sensor: (len(gee_download.BANDS[sensor]), size, size) for sensor in gee_download.SENSORS}
+
+
+if __name__ == '__main__':
+    # setting up config based on parsed argument
+    parser = args.argument_parser()
+    args = parser.parse_known_args()[0]
+    cfg = setup(args)
+
+    # appending the downloaded patches of the roi to the dataset in PATH/dataset, stacked exports have to be split
+    # with split_stacked.py first
+    store = PatchStore(f'{cfg.PATH}dataset', modalities(cfg))
+    n = store.append(cfg.ROI.ID, iter_city_patches(cfg))
+    print(f'{n} patches of {cfg.ROI.ID} appended, {len(store)} patches in the dataset')
@@ -0,0 +1,158 @@
+import ee
+import numpy as np
+from functools import lru_cache
+from pyproj import Transformer
+
+import instrumentation
+
+WGS84 = 'EPSG:4326'
+
+
+@lru_cache(maxsize=None)
+def _transformer(src_crs: str, dst_crs: str) -> Transformer:
+    return Transformer.from_crs(src_crs, dst_crs, always_xy=True)
+
+
+def roi_edges(cfg, n: int = 101) -> dict:
+    # edges of the lng/lat box of the roi projected to its utm zone, densified since they are curved in utm. The
+    # bottom and top edges run from west to east, the left and right edges from south to north
+    lng_min, lng_max = cfg.ROI.LNG_RANGE
+    lat_min, lat_max = cfg.ROI.LAT_RANGE
+    t = np.linspace(0, 1, n)
+    lngs, lats = lng_min + t * (lng_max - lng_min), lat_min + t * (lat_max - lat_min)
+    return {
+        'bottom': project(cfg, np.stack([lngs, np.full_like(t, lat_min)], axis=1)),
+        'top': project(cfg, np.stack([lngs, np.full_like(t, lat_max)], axis=1)),
+        'left': project(cfg, np.stack([np.full_like(t, lng_min), lats], axis=1)),
+        'right': project(cfg, np.stack([np.full_like(t, lng_max), lats], axis=1))
+    }
+
+
+def roi_area(cfg) -> float:
+    # area of the roi in square meters of its utm zone (shoelace formula on the densified outline)
+    edges = roi_edges(cfg)
+    ring = np.concatenate([edges['bottom'], edges['right'], edges['top'][::-1], edges['left'][::-1]])
+    x, y = ring[:, 0], ring[:, 1]
+    return float(abs(np.dot(x, np.roll(y, -1)) - np.dot(y, np.roll(x, -1))) / 2)
+
+
+def roi_inner_bounds(cfg) -> np.ndarray:
+    # largest axis-aligned utm rectangle within the roi as xmin, ymin, xmax, ymax
+    edges = roi_edges(cfg)
+    return np.array([edges['left'][:, 0].max(), edges['bottom'][:, 1].max(),
+                     edges['right'][:, 0].min(), edges['top'][:, 1].min()])
+
+
+def half_width(cfg) -> float:
+    # distance from the patch center to its edges in meters
+    return cfg.SAMPLING.PATCH_SIZE / 2 * cfg.PIXEL_SPACING
+
+
+def project(cfg, coords: np.ndarray) -> np.ndarray:
+    # (n, 2) array of lng/lat to (n, 2) array of x/y in the utm zone of the roi
+    coords = np.asarray(coords, dtype=np.float64).reshape(-1, 2)
+    x, y = _transformer(WGS84, cfg.ROI.UTM_EPSG).transform(coords[:, 0], coords[:, 1])
+    return np.stack([x, y], axis=1)
+
+
+def unproject(cfg, coords: np.ndarray) -> np.ndarray:
+    # inverse of project
+    coords = np.asarray(coords, dtype=np.float64).reshape(-1, 2)
+    lng, lat = _transformer(cfg.ROI.UTM_EPSG, WGS84).transform(coords[:, 0], coords[:, 1])
+    return np.stack([lng, lat], axis=1)
+
+
+def patch_bounds(cfg, coords: np.ndarray) -> np.ndarray:
+    # (n, 2) array of patch centers (lng/lat) to (n, 4) array of xmin, ymin, xmax, ymax in the utm zone of the roi
+    centers = project(cfg, coords)
+    d = half_width(cfg)
+    bounds = np.concatenate([centers - d, centers + d], axis=1)
+    if cfg.SAMPLING.SNAP_TO_GRID:
+        bounds = snap_bounds(cfg, bounds)
+    return bounds
+
+
+def snap_bounds(cfg, bounds: np.ndarray) -> np.ndarray:
+    # moves the lower left corners to the nearest multiple of PIXEL_SPACING, the global pixel grid of the utm zone
+    bounds = np.asarray(bounds, dtype=np.float64).reshape(-1, 4)
+    origins = np.round(bounds[:, :2] / cfg.PIXEL_SPACING) * cfg.PIXEL_SPACING
+    return np.concatenate([origins, origins + 2 * half_width(cfg)], axis=1)
+
+
+def grid_patch_id(cfg, bounds: np.ndarray) -> str:
+    # id of a snapped patch that only depends on its position in the utm zone, the pixel spacing and the patch size,
+    # e.g. 32634_10m_256px_32810_658700 for the patch with its lower left corner at pixel column 32810 and row 658700
+    xmin, ymin = [int(round(b / cfg.PIXEL_SPACING)) for b in bounds[:2]]
+    zone = cfg.ROI.UTM_EPSG.split(':')[-1]
+    return f'{zone}_{cfg.PIXEL_SPACING:g}m_{cfg.SAMPLING.PATCH_SIZE}px_{xmin}_{ymin}'
+
+
+def patch_id(cfg, bounds: np.ndarray, i: int):
+    # grid id of snapped patches, otherwise the index of the patch in the points file
+    return grid_patch_id(cfg, bounds) if cfg.SAMPLING.SNAP_TO_GRID else i
+
+
+def features_to_bounds(cfg, features: list) -> np.ndarray:
+    coords = np.array([feature['geometry']['coordinates'] for feature in features], dtype=np.float64)
+    return patch_bounds(cfg, coords)
+
+
+def iter_bounds(cfg, features, chunk_size: int = 1024):
+    # streaming variant of features_to_bounds, the bounds are computed in vectorized chunks and yielded one by one
+    chunk = []
+    for feature in features:
+        chunk.append(feature)
+        if len(chunk) == chunk_size:
+            with instrumentation.stage('geometry'):
+                bounds = features_to_bounds(cfg, chunk)
+            yield from bounds
+            chunk = []
+    if chunk:
+        with instrumentation.stage('geometry'):
+            bounds = features_to_bounds(cfg, chunk)
+        yield from bounds
+
+
+def bounds_to_polygons(cfg, bounds: np.ndarray) -> np.ndarray:
+    # (n, 4) utm bounds to (n, 5, 2) closed lng/lat rings (counter clockwise, starting at the lower left corner)
+    bounds = np.asarray(bounds, dtype=np.float64).reshape(-1, 4)
+    xmin, ymin, xmax, ymax = bounds.T
+    corners = np.stack([
+        np.stack([xmin, ymin], axis=1),
+        np.stack([xmax, ymin], axis=1),
+        np.stack([xmax, ymax], axis=1),
+        np.stack([xmin, ymax], axis=1),
+        np.stack([xmin, ymin], axis=1)
+    ], axis=1)
+    return unproject(cfg, corners.reshape(-1, 2)).reshape(-1, 5, 2)
+
+
+def polygon_bounds(rings: np.ndarray) -> np.ndarray:
+    # (n, k, 2) or (k, 2) rings to (n, 4) array of xmin, ymin, xmax, ymax
+    rings = np.asarray(rings, dtype=np.float64)
+    if rings.ndim == 2:
+        rings = rings[np.newaxis]
+    return np.concatenate([rings.min(axis=1), rings.max(axis=1)], axis=1)
+
+
+def bounds_to_geometry(cfg, bounds: np.ndarray) -> ee.Geometry:
+    # planar rectangle in the utm zone of the roi, constructed client-side without any request
+    xmin, ymin, xmax, ymax = [float(b) for b in bounds]
+    return ee.Geometry.Rectangle([xmin, ymin, xmax, ymax], cfg.ROI.UTM_EPSG, False)
+
+
+def ee_patch(cfg, point: ee.Geometry) -> ee.Geometry:
+    # server-side reference definition of a patch, the local functions above reproduce it
+    crs = cfg.ROI.UTM_EPSG
+    point = ee.Geometry(point).transform(crs)
+    patch = point.buffer(distance=half_width(cfg), proj=crs).bounds(proj=crs)
+    return patch
+
+
+def compare_with_server(cfg, coords: np.ndarray) -> float:
+    # maximum deviation in meters between local patch bounds and the ones computed by earth engine
+    local_bounds = patch_bounds(cfg, coords)
+    points = ee.List([ee.Geometry.Point([float(lng), float(lat)]) for lng, lat in np.asarray(coords).reshape(-1, 2)])
+    server_rings = points.map(lambda p: ee_patch(cfg, p).coordinates().get(0)).getInfo()
+    server_bounds = polygon_bounds(np.array(server_rings))
+    return float(np.abs(local_bounds - server_bounds).max())
@@ -0,0 +1,108 @@
+import json
+import numpy as np
+import os
+
+
+class PatchStore(object):
+    """
+    Training patches of several modalities (e.g. sentinel1, sentinel2 and buildings) packed into one contiguous
+    binary file per modality with a fixed (bands, height, width) shape per patch, plus an append-only index of the
+    patches (city, patch id, geotransform and density zone). Row i of every modality belongs to index entry i.
+
+    Patches are read as zero-copy views of read-only memory maps. Cities are appended at the end of the files, the
+    existing data is never rewritten.
+    """
+    META_FILE = 'store.json'
+    INDEX_FILE = 'index.jsonl'
+
+    def __init__(self, path: str, modalities: dict = None, dtype: str = 'float32'):
+        # modalities maps names to patch shapes and is only required to create a new store
+        self.path = path
+        meta_file = os.path.join(path, self.META_FILE)
+        if os.path.isfile(meta_file):
+            with open(meta_file) as f:
+                meta = json.load(f)
+        else:
+            if modalities is None:
+                raise FileNotFoundError(f'No patch store in {path}, modalities are needed to create one')
+            os.makedirs(path, exist_ok=True)
+            meta = {'dtype': dtype, 'modalities': {name: list(shape) for name, shape in modalities.items()}}
+            with open(meta_file, 'w') as f:
+                json.dump(meta, f, indent=4)
+        self.dtype = np.dtype(meta['dtype'])
+        self.shapes = {name: tuple(shape) for name, shape in meta['modalities'].items()}
+
+        self.index = []
+        index_file = os.path.join(path, self.INDEX_FILE)
+        if os.path.isfile(index_file):
+            with open(index_file) as f:
+                self.index = [json.loads(line) for line in f if line.strip()]
+        self._rows = {(record['city'], record['patch']): i for i, record in enumerate(self.index)}
+        self._arrays = {}
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def data_file(self, modality: str) -> str:
+        return os.path.join(self.path, f'{modality}.bin')
+
+    def patch_bytes(self, modality: str) -> int:
+        return int(np.prod(self.shapes[modality])) * self.dtype.itemsize
+
+    def contains(self, city: str, patch: int) -> bool:
+        return (city, patch) in self._rows
+
+    def row(self, city: str, patch: int) -> int:
+        return self._rows[(city, patch)]
+
+    def append(self, city: str, patches) -> int:
+        """
+        Appends the patches of a city, an iterable of (patch id, {modality: array}, geotransform, density zone).
+        Patches that are already stored are skipped, returns the number of appended patches.
+        """
+        # data beyond the indexed rows is left over from an interrupted append and is overwritten
+        for modality in self.shapes:
+            if os.path.isfile(self.data_file(modality)):
+                with open(self.data_file(modality), 'r+b') as f:
+                    f.truncate(len(self) * self.patch_bytes(modality))
+
+        files = {modality: open(self.data_file(modality), 'ab') for modality in self.shapes}
+        n = 0
+        try:
+            with open(os.path.join(self.path, self.INDEX_FILE), 'a') as index_file:
+                for patch, arrays, transform, density_zone in patches:
+                    if self.contains(city, patch):
+                        continue
+                    for modality, shape in self.shapes.items():
+                        arr = np.ascontiguousarray(arrays[modality], dtype=self.dtype)
+                        if arr.shape != shape:
+                            raise ValueError(f'{modality} patch {patch} of {city} has shape {arr.shape}, not {shape}')
+                        files[modality].write(arr.tobytes())
+                    # the index entry is written after the data so that it never refers to missing rows
+                    for f in files.values():
+                        f.flush()
+                    record = {'city': city, 'patch': patch, 'transform': list(transform), 'density_zone': density_zone}
+                    index_file.write(json.dumps(record) + '\n')
+                    index_file.flush()
+                    self._rows[(city, patch)] = len(self.index)
+                    self.index.append(record)
+                    n += 1
+        finally:
+            for f in files.values():
+                f.close()
+        self._arrays = {}
+        return n
+
+    def array(self, modality: str) -> np.ndarray:
+        # read-only (n, bands, height, width) memory map of all patches of the modality
+        if modality not in self._arrays:
+            shape = (len(self),) + self.shapes[modality]
+            if len(self) == 0:
+                return np.empty(shape, dtype=self.dtype)
+            self._arrays[modality] = np.memmap(self.data_file(modality), dtype=self.dtype, mode='r', shape=shape)
+        return self._arrays[modality]
+
+    def __getitem__(self, i: int) -> dict:
+        patch = {modality: self.array(modality)[i] for modality in self.shapes}
+        patch.update(self.index[i])
+        return patch
@@ -0,0 +1,96 @@
+import glob
+import json
+import os
+import re
+
+# newline-delimited files hold one feature per line
+LINE_DELIMITED_EXTENSIONS = ['.geojsonl', '.geojsons', '.ndjson', '.jsonl']
+CHUNK_SIZE = 1 << 16
+
+
+def points_files(cfg) -> list:
+    # single points file of the roi or, if it does not exist, its shards (e.g. points_{ROI.ID}_0001.geojson)
+    file = f'{cfg.PATH}points_{cfg.ROI.ID}.geojson'
+    if os.path.isfile(file):
+        return [file]
+    # only numeric shard suffixes, points_{ROI.ID}_* also matches the files of rois whose id has ROI.ID as prefix
+    pattern = re.compile(rf'points_{re.escape(cfg.ROI.ID)}_(\d+)(\.\w+)*')
+    shards = {}
+    for file in glob.glob(f'{cfg.PATH}points_{cfg.ROI.ID}_*'):
+        match = pattern.fullmatch(os.path.basename(file))
+        if match:
+            shards[file] = int(match.group(1))
+    files = sorted(shards, key=shards.get)
+    if not files:
+        raise FileNotFoundError(f'No points file found for {cfg.ROI.ID} in {cfg.PATH}')
+    return files
+
+
+def iter_feature_collection(file: str, chunk_size: int = CHUNK_SIZE):
+    # yields the items of the features array of a GeoJSON FeatureCollection without loading the whole file
+    decoder = json.JSONDecoder()
+    with open(file) as f:
+        buffer = ''
+        eof = False
+
+        def read() -> bool:
+            nonlocal buffer, eof
+            chunk = f.read(chunk_size)
+            eof = not chunk
+            buffer += chunk
+            return not eof
+
+        # skipping everything up to the opening bracket of the features array
+        while True:
+            start = buffer.find('"features"')
+            if start != -1:
+                bracket = buffer.find('[', start)
+                if bracket != -1:
+                    buffer = buffer[bracket + 1:]
+                    break
+            if not read():
+                return
+
+        while True:
+            pos = 0
+            while pos < len(buffer) and buffer[pos] in ' \t\r\n,':
+                pos += 1
+            if pos == len(buffer):
+                buffer = ''
+                if not read():
+                    raise ValueError(f'Unterminated features array in {file}')
+                continue
+            if buffer[pos] == ']':
+                return
+            try:
+                feature, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                # feature continues in the next chunk
+                if not read():
+                    raise
+                continue
+            buffer = buffer[end:]
+            yield feature
+
+
+def iter_line_delimited(file: str):
+    with open(file) as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
+def iter_features(files: list):
+    for file in files:
+        if os.path.splitext(file)[1] in LINE_DELIMITED_EXTENSIONS:
+            yield from iter_line_delimited(file)
+        else:
+            yield from iter_feature_collection(file)
+
+
+def iter_sampled_features(files: list):
+    # points of density zone 0 (no buildings in the neighborhood) are not exported
+    for feature in iter_features(files):
+        if feature.get('properties').get('densityZone') != 0:
+            yield feature
@@ -1,14 +1,30 @@
 import ee
+import utils
 
 
-def single_orbit_mean(patch: ee.Geometry, date_range) -> ee.Image:
-
-    # sup-setting data
+def filtered_collection(geom: ee.Geometry, date_range) -> ee.ImageCollection:
     col = ee.ImageCollection('COPERNICUS/S1_GRD') \
-        .filterBounds(patch) \
+        .filterBounds(geom) \
         .filterDate(date_range.start(), date_range.end()) \
         .filterMetadata('instrumentMode', 'equals', 'IW') \
         .select(['VV', 'VH'])
+    return col
+
+
+# collection of the whole roi, built once and narrowed down to each patch
+@utils.memoize_graph('ROI.LNG_RANGE', 'ROI.LAT_RANGE', 'SATELLITE_DATA.DATE_RANGE')
+def roi_collection(cfg) -> ee.ImageCollection:
+    return filtered_collection(utils.extract_bbox(cfg), utils.extract_date_range(cfg))
+
+
+def single_orbit_mean(patch: ee.Geometry, date_range, col: ee.ImageCollection = None,
+                      filter_bounds: bool = True) -> ee.Image:
+
+    # sup-setting data, a given collection that already only holds the scenes of the patch is not filtered again
+    if col is None:
+        col = filtered_collection(patch, date_range)
+    elif filter_bounds:
+        col = col.filterBounds(patch)
 
     # masking noise
     col = col.map(lambda img: img.updateMask(img.gte(-25)))
@@ -19,17 +35,11 @@ def single_orbit_mean(patch: ee.Geometry, date_range) -> ee.Image:
     col = ee.Algorithms.If(ee.Number(asc_col.size()).gt(desc_col.size()), asc_col, desc_col)
     col = ee.ImageCollection(col)
 
-    # getting distinct orbit numbers
-    orbit_numbers = col \
-        .toList(col.size()) \
-        .map(lambda img: ee.Number(ee.Image(img).get('relativeOrbitNumber_start'))) \
-        .distinct().getInfo()
-
-    # computing separate mean backscatter image for each orbit number
-    means = ee.ImageCollection([])
-    for number in orbit_numbers:
-        mean = col.filterMetadata('relativeOrbitNumber_start', 'equals', number).mean()
-        means = means.merge(ee.ImageCollection([mean]))
+    # computing separate mean backscatter image for each distinct orbit number on the server, distinct keeps the
+    # order of first occurrence so that the mosaic stacks the orbit means as before
+    orbit_numbers = col.aggregate_array('relativeOrbitNumber_start').distinct()
+    means = orbit_numbers.map(lambda number: col.filterMetadata('relativeOrbitNumber_start', 'equals', number).mean())
+    means = ee.ImageCollection.fromImages(means)
 
     mosaic = means \
         .mosaic() \
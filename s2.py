@@ -1,4 +1,6 @@
 import ee
+import ee_cache
+import utils
 
 
 def add_cloud_band(img: ee.Image) -> ee.Image:
@@ -36,15 +38,82 @@ def add_stats(img: ee.Image) -> ee.Image:
     return img
 
 
-def cloud_free_mosaic(patch: ee.Geometry, date_range) -> ee.Image:
+def add_stats_fast(img: ee.Image, max_cloud_error: float = 0.1) -> ee.Image:
+    # cheaper variant of add_stats: the coverage is 1 without any area computation if the footprint contains the
+    # patch and the cloud fraction is the mean of the cloud band at a scale that keeps the error due to pixels
+    # crossing the patch boundary (at most 4 * scale / patch width) below max_cloud_error, bounded by the 10 m of the
+    # exact computation and the 60 m native resolution of QA60
+    patch = ee.Geometry(img.get('patch'))
+    patch_area = patch.area(0.001)
+
+    img_footprint = ee.Algorithms.GeometryConstructors.Polygon(
+        ee.Geometry(img.get('system:footprint')).coordinates()
+    )
+    coverage = ee.Number(ee.Algorithms.If(
+        img_footprint.contains(patch, ee.ErrorMargin(0.001)),
+        1,
+        ee.Number(patch.intersection(img_footprint, ee.ErrorMargin(0.001)).area(0.001)).divide(patch_area)
+    ))
+
+    scale = ee.Number(max_cloud_error).multiply(ee.Number(patch_area).sqrt()).divide(4).max(10).min(60)
+    stats = img.select('clouds').gt(0).reduceRegion(
+        reducer=ee.Reducer.mean(),
+        geometry=patch,
+        scale=scale,
+        maxPixels=1e12
+    )
+    # a footprint that only grazes the patch can leave no unmasked pixel at the coarse scale and a null mean, the
+    # sum of add_stats is 0 in that case
+    clouds = stats.get('clouds')
+    cloud_fraction = ee.Number(ee.Algorithms.If(ee.Algorithms.IsEqual(clouds, None), 0, clouds))
+    cloud_coverage = cloud_fraction.multiply(coverage)
+    img = img.set('patchCoverage', coverage)
+    img = img.set('patchCloudCoverage', cloud_coverage)
+
+    score = coverage.multiply(cloud_coverage)
+    img = img.set('patchScore', score)
+    return img
+
 
-    s2toa = ee.ImageCollection('COPERNICUS/S2') \
+def filtered_collection(geom: ee.Geometry, date_range) -> ee.ImageCollection:
+    col = ee.ImageCollection('COPERNICUS/S2') \
         .filterDate(date_range.start(), date_range.end()) \
-        .filterBounds(patch) \
+        .filterBounds(geom)
+    return col
+
+
+# collection of the whole roi, built once and narrowed down to each patch
+@utils.memoize_graph('ROI.LNG_RANGE', 'ROI.LAT_RANGE', 'SATELLITE_DATA.DATE_RANGE')
+def roi_collection(cfg) -> ee.ImageCollection:
+    return filtered_collection(utils.extract_bbox(cfg), utils.extract_date_range(cfg))
+
+
+def scored_collection(patch: ee.Geometry, date_range, col: ee.ImageCollection = None, fast: bool = False,
+                      max_scene_cloud: float = 100, max_cloud_error: float = 0.1,
+                      filter_bounds: bool = True) -> ee.ImageCollection:
+
+    # a given collection that already only holds the scenes of the patch is not filtered again
+    if col is None:
+        col = filtered_collection(patch, date_range)
+    elif filter_bounds:
+        col = col.filterBounds(patch)
+
+    # the fast path drops scenes by their metadata before any statistics are computed
+    if fast:
+        col = col.filterMetadata('CLOUDY_PIXEL_PERCENTAGE', 'not_greater_than', max_scene_cloud)
+
+    s2toa = col \
         .map(add_cloud_band) \
-        .map(lambda img: img.set('patch', patch)) \
-        .map(add_stats)
+        .map(lambda img: img.set('patch', patch))
+
+    if fast:
+        s2toa = s2toa.map(lambda img: add_stats_fast(img, max_cloud_error))
+    else:
+        s2toa = s2toa.map(add_stats)
+    return s2toa
 
+
+def select_best(s2toa: ee.ImageCollection) -> tuple:
     cloud_free_candidates = s2toa \
         .filterMetadata('patchCoverage', 'equals', 1) \
         .filterMetadata('patchCloudCoverage', 'equals', 0)
@@ -58,6 +127,16 @@ def cloud_free_mosaic(patch: ee.Geometry, date_range) -> ee.Image:
         .sort('CLOUDY_PIXEL_PERCENTAGE') \
         .first()
 
+    return best, best_local
+
+
+def cloud_free_mosaic(patch: ee.Geometry, date_range, col: ee.ImageCollection = None, fast: bool = False,
+                      max_scene_cloud: float = 100, max_cloud_error: float = 0.1,
+                      filter_bounds: bool = True) -> ee.Image:
+
+    s2toa = scored_collection(patch, date_range, col, fast, max_scene_cloud, max_cloud_error, filter_bounds)
+    best, best_local = select_best(s2toa)
+
     s2toa_no_clouds = s2toa.map(lambda img: img.updateMask(img.select('clouds').Not()))
 
     cloud_free_mosaic = s2toa_no_clouds.sort('patchScore', False).mosaic()
@@ -66,3 +145,28 @@ def cloud_free_mosaic(patch: ee.Geometry, date_range) -> ee.Image:
     final = final.select(['B2', 'B3', 'B4', 'B8', 'B11', 'B12']).divide(10000).clamp(0, 1).unmask().float()
 
     return final
+
+
+def selected_scene_ids(patch: ee.Geometry, date_range, col: ee.ImageCollection = None, **fast_params) -> ee.List:
+    # ids of the best and best_local scenes of the exact and the fast path, empty strings if there is none
+    def scene_id(img) -> ee.String:
+        return ee.Algorithms.If(img, ee.Image(img).get('system:index'), '')
+
+    ids = []
+    for fast in [False, True]:
+        best, best_local = select_best(scored_collection(patch, date_range, col, fast, **fast_params))
+        ids.extend([scene_id(best), scene_id(best_local)])
+    return ee.List(ids)
+
+
+def validate_fast_stats(patches: list, date_range, col: ee.ImageCollection = None, **fast_params) -> dict:
+    # fraction of the patches for which the fast path selects a different best and best_local scene
+    ids = ee_cache.get_info(ee.List([selected_scene_ids(patch, date_range, col, **fast_params) for patch in patches]),
+                            use_cache=False)
+    n_best = sum(1 for patch_ids in ids if patch_ids[0] != patch_ids[2])
+    n_best_local = sum(1 for patch_ids in ids if patch_ids[1] != patch_ids[3])
+    return {
+        'patches': len(ids),
+        'best_changed': n_best / max(len(ids), 1),
+        'best_local_changed': n_best_local / max(len(ids), 1)
+    }
@@ -0,0 +1,46 @@
+import ee
+
+from download_manager import args
+from download_manager.config import config
+
+import ee_cache
+import gee_download
+import patch_geometry
+import points
+import s2
+import utils
+
+
+def setup(args):
+    cfg = config.new_config()
+    cfg.merge_from_file(f'configs/{args.config_file}.yaml')
+    cfg.merge_from_list(args.opts)
+    cfg.NAME = args.config_file
+    return cfg
+
+
+if __name__ == '__main__':
+    # setting up config based on parsed argument
+    parser = args.argument_parser()
+    args = parser.parse_known_args()[0]
+    cfg = setup(args)
+
+    ee.Initialize()
+    ee_cache.configure(cfg)
+
+    # checking for the first sampled patches how often the fast statistics select a different scene than the exact
+    # ones, the fast path is worth enabling if best and best_local hardly change
+    date_range = utils.extract_date_range(cfg)
+    n_patches = 50
+    features = points.iter_sampled_features(points.points_files(cfg))
+    patches = []
+    for bounds in patch_geometry.iter_bounds(cfg, features):
+        patches.append(patch_geometry.bounds_to_geometry(cfg, bounds))
+        if len(patches) == n_patches:
+            break
+
+    params = gee_download.s2_params(cfg)
+    params.pop('fast')
+    stats = s2.validate_fast_stats(patches, date_range, s2.roi_collection(cfg), **params)
+    print(f'{stats["patches"]} patches: best changed for {stats["best_changed"]:.1%}, '
+          f'best_local changed for {stats["best_local_changed"]:.1%}')
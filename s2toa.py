@@ -43,7 +43,7 @@ def compute_cloud_coverage(img, cloud_thresh=0.2):
     return img
 
 
-def compute_cloud_score(img):
+def compute_cloud_score(img, proj: ee.Projection = None):
     toa = img.select(['B1','B2','B3','B4','B5','B6','B7','B8','B8A', 'B9','B10', 'B11','B12']) \
               .divide(10000)
 
@@ -75,7 +75,7 @@ def compute_cloud_score(img):
     score = score.max(ee.Image(0.001))
 
     # Remove small regions and clip the upper bound
-    dilated = dilated_erosion(score).min(ee.Image(1.0))
+    dilated = dilated_erosion(score, proj=proj).min(ee.Image(1.0))
 
     score = score.reduceNeighborhood(
         reducer=ee.Reducer.mean(),
@@ -91,13 +91,23 @@ def rescale(img, exp, thresholds):
               .divide(thresholds[1] - thresholds[0])
 
 
-def dilated_erosion(score, dilation_pixels=3, erode_pixels=1.5):
-    # Perform opening on the cloud scores
+# Projection in which the focal operations of the cloud and shadow scoring are performed: the native utm projection
+# of the scene if no crs is given (e.g. the export crs), at the working scale in meters
+def working_projection(img: ee.Image, crs: str = None, scale: float = 20) -> ee.Projection:
+    if crs is None:
+        return img.select(['B2']).projection().atScale(scale)
+    return ee.Projection(crs).atScale(scale)
+
+
+def dilated_erosion(score, dilation_pixels=3, erode_pixels=1.5, proj: ee.Projection = None):
+    # Perform opening on the cloud scores, in EPSG:4326 at 20 m unless a working projection is given
+    if proj is None:
+        proj = ee.Projection('EPSG:4326').atScale(20)
     score = score \
-        .reproject('EPSG:4326', None, 20) \
+        .reproject(proj) \
         .focal_min(radius=erode_pixels, kernelType='circle', iterations=3) \
         .focal_max(radius=dilation_pixels, kernelType='circle', iterations=3) \
-        .reproject('EPSG:4326', None, 20)
+        .reproject(proj)
     return score
 
 
@@ -105,16 +115,44 @@ def clipToROI(x, roi):
     return x.clip(roi).set('ROI', roi)
 
 
+def fine_height_step(zen_rad: ee.Number, shadow_scale: float = 20, shadow_tolerance: float = 9) -> ee.Number:
+    # height difference for which the shadow moves by shadow_tolerance pixels of shadow_scale
+    return ee.Number(shadow_tolerance).multiply(shadow_scale).divide(zen_rad.tan())
+
+
+def min_reduced_step(cloud_heights: list) -> float:
+    # twice the mean spacing of cloud_heights, the finest spacing of the 'reduced' shadow mode
+    return 2 * (max(cloud_heights) - min(cloud_heights)) / max(len(cloud_heights) - 1, 1)
+
+
 # Implementation of Basic cloud shadow shift
 # Author: Gennadii Donchyts
 # License: Apache 2.0
 # Modified by Lloyd Hughes to reduce spurious cloud shadow masks
+#
+# shadow_mode selects the cloud heights for which shadows are projected:
+#   'full': all cloud_heights (39 displacements per scene by default)
+#   'reduced': heights between the lowest and highest of cloud_heights spaced such that the shadows of consecutive
+#              heights are shadow_tolerance pixels of shadow_scale apart, derived from the solar zenith angle of the
+#              scene. The default of 9 pixels is the gap the dilated erosion of the shadow mask still closes (3
+#              iterations of 3 - 1.5 pixels on either side). The spacing is at least twice the mean spacing of
+#              cloud_heights, so at most about half as many heights as 'full' are projected (20 instead of 39 by
+#              default, from a zenith angle of ~20 degrees on), accepting wider gaps between the shadows
+#   'coarse_to_fine': a coarse search over every coarse_step meters picks the height whose shadow best matches the
+#                     dark pixels of the scene, only the heights around it are projected, shadow_tolerance pixels
+#                     apart
+#
+# displace_mode is the interpolation of the projected cloud scores, s2toa_local implements 'bilinear'
 def compute_shadow_score(img: ee.Image, cloud_heights=list(range(200, 10000, 250)), cloud_thresh=0.2,
-                         ir_sum_thresh=0.3, ndvi_thresh=-0.1) -> ee.Image:
+                         ir_sum_thresh=0.3, ndvi_thresh=-0.1, shadow_mode: str = 'full', shadow_scale: float = 20,
+                         shadow_tolerance: float = 9, coarse_step: float = 1000, coarse_scale: float = 100,
+                         proj: ee.Projection = None, displace_mode: str = 'bicubic') -> ee.Image:
 
     mean_azimuth = img.get('MEAN_SOLAR_AZIMUTH_ANGLE')
     mean_zenith = img.get('MEAN_SOLAR_ZENITH_ANGLE')
 
+    min_height, max_height = min(cloud_heights), max(cloud_heights)
+    cloud_heights_list = list(cloud_heights)
     cloud_heights = ee.List(cloud_heights)
 
     cloud_mask = img.select(['cloudScore']).gt(cloud_thresh)
@@ -145,7 +183,34 @@ def compute_shadow_score(img: ee.Image, cloud_heights=list(range(200, 10000, 250
         x = az_rad.sin().multiply(shadow_casted_distance).multiply(-1)  # .divide(nominalScale)#X distance of shadow
         y = az_rad.cos().multiply(shadow_casted_distance).multiply(-1)  # Y distance of shadow
         # return cloudMask.changeProj(cloudMask.projection(), cloudMask.projection().translate(x, y))
-        return img.select(['cloudScore']).displace(ee.Image.constant(x).addBands(ee.Image.constant(y)))
+        return img.select(['cloudScore']).displace(ee.Image.constant(x).addBands(ee.Image.constant(y)),
+                                                   mode=displace_mode)
+
+    fine_step = fine_height_step(zen_rad, shadow_scale, shadow_tolerance)
+
+    if shadow_mode == 'reduced':
+        cloud_heights = ee.List.sequence(min_height, max_height, fine_step.max(min_reduced_step(cloud_heights_list)))
+
+    if shadow_mode == 'coarse_to_fine':
+        def shadow_match(cloud_height):
+            # mean shadow overlap with dark pixels, evaluated at a coarse scale
+            overlap = find_shadows(cloud_height).multiply(dark_pixel_mask).reduceRegion(
+                reducer=ee.Reducer.mean(),
+                geometry=img.geometry(),
+                scale=coarse_scale,
+                maxPixels=1e12,
+                bestEffort=True
+            )
+            return ee.Number(overlap.get('cloudScore', 0))
+
+        coarse_heights = ee.List.sequence(min_height, max_height, coarse_step)
+        matches = coarse_heights.map(shadow_match)
+        best_height = ee.Number(coarse_heights.get(matches.indexOf(matches.reduce(ee.Reducer.max()))))
+        cloud_heights = ee.List.sequence(
+            best_height.subtract(coarse_step / 2).max(min_height),
+            best_height.add(coarse_step / 2).min(max_height),
+            fine_step
+        )
 
     # Find the shadows
     shadows = cloud_heights.map(find_shadows)
@@ -154,7 +219,7 @@ def compute_shadow_score(img: ee.Image, cloud_heights=list(range(200, 10000, 250
     shadow_mask = shadow_masks.mean()
 
     # Create shadow mask
-    shadow_mask = dilated_erosion(shadow_mask.multiply(dark_pixel_mask))
+    shadow_mask = dilated_erosion(shadow_mask.multiply(dark_pixel_mask), proj=proj)
 
     shadow_score = shadow_mask.reduceNeighborhood(
         reducer=ee.Reducer.max(),
@@ -166,10 +231,12 @@ def compute_shadow_score(img: ee.Image, cloud_heights=list(range(200, 10000, 250
     return img
 
 
-def compute_quality_score(img):
+def compute_quality_score(img, proj: ee.Projection = None):
 
+    if proj is None:
+        proj = ee.Projection('EPSG:4326').atScale(20)
     score = img.select(['cloudScore']).max(img.select(['shadowScore']))
-    score = score.reproject('EPSG:4326', None, 20).reduceNeighborhood(
+    score = score.reproject(proj).reduceNeighborhood(
         reducer=ee.Reducer.mean(),
         kernel=ee.Kernel.square(5)
     )
@@ -178,19 +245,129 @@ def compute_quality_score(img):
     return img.addBands(score.rename('cloudShadowScore'))
 
 
-def cloud_free_mosaic(roi: ee.Geometry, date_range, cloud_free_keep_thresh: float = 5) -> ee.Image:
+def shadow_height_counts(img: ee.Image, cloud_heights=list(range(200, 10000, 250)), shadow_scale: float = 20,
+                         shadow_tolerance: float = 9, coarse_step: float = 1000) -> dict:
+    # number of heights compute_shadow_score projects in each shadow mode for the solar zenith angle of the scene
+    min_height, max_height = min(cloud_heights), max(cloud_heights)
+    zen_rad = ee.Number(img.get('MEAN_SOLAR_ZENITH_ANGLE')).multiply(math.pi).divide(180.0)
+    fine_step = fine_height_step(zen_rad, shadow_scale, shadow_tolerance)
+    reduced_step = fine_step.max(min_reduced_step(cloud_heights))
+    n_coarse = ee.List.sequence(min_height, max_height, coarse_step).size()
+    return {
+        'full': ee.Number(len(cloud_heights)),
+        'reduced': ee.List.sequence(min_height, max_height, reduced_step).size(),
+        'coarse_to_fine': n_coarse.add(ee.List.sequence(0, coarse_step, fine_step).size())
+    }
+
+
+def compare_shadow_modes(img: ee.Image, roi: ee.Geometry, modes: list = ('reduced', 'coarse_to_fine'),
+                         shadow_thresh: float = 0.2, scale: float = 20) -> ee.Dictionary:
+    # agreement of the shadow masks of the given modes with the mask of the full 39-height projection, for each mode
+    # the fraction of equally classified pixels, the intersection over union of the shadow pixels and the number of
+    # projected heights (coarse and fine heights for 'coarse_to_fine')
+    img = compute_cloud_score(ee.Image(img).clip(roi))
+    n_heights = shadow_height_counts(img)
+    reference = compute_shadow_score(img, shadow_mode='full').select('shadowScore').gt(shadow_thresh)
+
+    stats = {}
+    for mode in modes:
+        mask = compute_shadow_score(img, shadow_mode=mode).select('shadowScore').gt(shadow_thresh)
+        comparison = ee.Image.cat([
+            mask.eq(reference).rename('agreement'),
+            mask.And(reference).rename('intersection'),
+            mask.Or(reference).rename('union')
+        ])
+        means = comparison.reduceRegion(
+            reducer=ee.Reducer.mean(),
+            geometry=roi,
+            scale=scale,
+            maxPixels=1e12,
+            bestEffort=True,
+            tileScale=16
+        )
+        iou = ee.Number(means.get('intersection')).divide(ee.Number(means.get('union')).max(1e-12))
+        stats[mode] = ee.Dictionary({'agreement': means.get('agreement'), 'iou': iou, 'heights': n_heights[mode]})
+
+    return ee.Dictionary(stats)
+
+
+# cheap ranking of a scene for the roi, computed before any per-pixel scoring:
+#                - CANDIDATE_COVERAGE: fraction of the roi covered by the scene footprint
+#                - CANDIDATE_CLOUD: cloud fraction over the roi from the QA60 band at a coarse scale
+#                - CANDIDATE_SCORE: coverage times the clear fractions of the coarse estimate and of the whole scene
+def compute_candidate_score(img: ee.Image, roi: ee.Geometry, coarse_scale: float = 300) -> ee.Image:
+    max_area_error = 10
+    img_poly = ee.Algorithms.GeometryConstructors.Polygon(
+        ee.Geometry(img.get('system:footprint')).coordinates()
+    )
+    intersection = roi.intersection(img_poly, ee.ErrorMargin(max_area_error))
+    coverage = ee.Number(intersection.area(max_area_error)).divide(roi.area(max_area_error))
+
+    qa60 = img.select(['QA60'])
+    clouds = qa60.bitwiseAnd(1 << 10).Or(qa60.bitwiseAnd(1 << 11)).gt(0).rename('clouds')
+    stats = clouds.reduceRegion(
+        reducer=ee.Reducer.mean(),
+        geometry=roi,
+        scale=coarse_scale,
+        maxPixels=1e12,
+        bestEffort=True
+    )
+    # a roi without any pixel of the scene yields a null fraction, a fully clear roi a fraction of 0
+    clouds = stats.get('clouds')
+    cloud_fraction = ee.Number(ee.Algorithms.If(ee.Algorithms.IsEqual(clouds, None), 1, clouds))
+
+    scene_clear = ee.Number(1).subtract(ee.Number(img.get('CLOUDY_PIXEL_PERCENTAGE')).divide(100))
+    score = coverage.multiply(ee.Number(1).subtract(cloud_fraction)).multiply(scene_clear)
+
+    img = img.set('CANDIDATE_COVERAGE', coverage)
+    img = img.set('CANDIDATE_CLOUD', cloud_fraction)
+    img = img.set('CANDIDATE_SCORE', score)
+    return img
+
+
+def prune_candidates(collection: ee.ImageCollection, roi: ee.Geometry, max_candidates: int) -> ee.ImageCollection:
+    # keeps the max_candidates best ranked scenes of each footprint group (mgrs tile and relative orbit), ties are
+    # resolved in favour of the more recent scene. A single ranking over a roi spanning several footprints could drop
+    # every scene of one of them and leave a hole in the mosaic
+    def footprint_group(img):
+        orbit = ee.Number(img.get('SENSING_ORBIT_NUMBER')).format('%d')
+        return img.set('CANDIDATE_GROUP', ee.String(img.get('MGRS_TILE')).cat('_').cat(orbit))
+
+    collection = collection \
+        .map(lambda img: compute_candidate_score(img, roi)) \
+        .map(footprint_group)
+
+    def group_candidates(group):
+        return collection \
+            .filterMetadata('CANDIDATE_GROUP', 'equals', group) \
+            .sort('system:time_start', False) \
+            .sort('CANDIDATE_SCORE', False) \
+            .limit(max_candidates)
+
+    groups = collection.aggregate_array('CANDIDATE_GROUP').distinct()
+    return ee.ImageCollection(ee.FeatureCollection(groups.map(group_candidates)).flatten())
+
+
+def cloud_free_mosaic(roi: ee.Geometry, date_range, cloud_free_keep_thresh: float = 5,
+                      shadow_mode: str = 'full', max_candidates: int = 0, working_crs: str = None,
+                      working_scale: float = 20) -> ee.Image:
 
     collection = ee.ImageCollection('COPERNICUS/S2') \
         .filterDate(date_range.start(), date_range.end()) \
         .filterBounds(roi)
 
+    # only the best candidates by metadata and a coarse cloud estimate are scored per pixel
+    if max_candidates:
+        collection = prune_candidates(collection, roi, max_candidates)
+
     collection = collection \
         .map(lambda img: img.clip(roi)) \
         .map(lambda img: img.set('ROI', roi)) \
-        .map(compute_cloud_score) \
+        .map(lambda img: compute_cloud_score(img, working_projection(img, working_crs, working_scale))) \
         .map(compute_cloud_coverage) \
-        .map(compute_shadow_score) \
-        .map(compute_quality_score) \
+        .map(lambda img: compute_shadow_score(img, shadow_mode=shadow_mode,
+                                              proj=working_projection(img, working_crs, working_scale))) \
+        .map(lambda img: compute_quality_score(img, working_projection(img, working_crs, working_scale))) \
         .sort('CLOUDY_PERCENTAGE')
 
     # print(collection.size().getInfo())
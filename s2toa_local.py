@@ -0,0 +1,398 @@
+"""
+NumPy port of the cloud and shadow scoring and of the quality mosaic of s2toa for downloaded scene chips.
+
+A scene is a dict with the bands of s2toa.compute_cloud_score as (height, width) arrays of top of atmosphere
+reflectance times 10000 under 'bands' (a dict or a structured array as returned by NPY downloads), the solar angles
+MEAN_SOLAR_AZIMUTH_ANGLE and MEAN_SOLAR_ZENITH_ANGLE, the FOOTPRINT_AREA of the whole scene in square meters (the area
+of system:footprint) and optionally a boolean 'valid' array of the pixels inside the scene footprint. All chips of a
+mosaic share the same grid with square pixels of scale meters, the chip being the roi of s2toa.cloud_free_mosaic.
+
+Masked pixels are represented by NaN: binary operations propagate them like earth engine masks and the neighborhood
+operations ignore them, including the pixels outside of the chip.
+"""
+import math
+import numpy as np
+
+BANDS = ['B1', 'B2', 'B3', 'B4', 'B5', 'B6', 'B7', 'B8', 'B8A', 'B9', 'B10', 'B11', 'B12']
+CLOUD_HEIGHTS = list(range(200, 10000, 250))
+
+
+def rescale(values: np.ndarray, thresholds: list) -> np.ndarray:
+    return (values - thresholds[0]) / (thresholds[1] - thresholds[0])
+
+
+def normalized_difference(first: np.ndarray, second: np.ndarray) -> np.ndarray:
+    # like ee.Image.normalizedDifference negative inputs are forced to 0
+    first, second = np.maximum(first, 0), np.maximum(second, 0)
+    total = first + second
+    with np.errstate(divide='ignore', invalid='ignore'):
+        nd = (first - second) / total
+    return np.where(total == 0, 0, nd)
+
+
+def _shifted(values: np.ndarray, dy: int, dx: int) -> np.ndarray:
+    # out[i, j] = values[i + dy, j + dx], NaN outside of the array
+    height, width = values.shape
+    out = np.full_like(values, np.nan)
+    if abs(dy) >= height or abs(dx) >= width:
+        return out
+    src_rows = slice(max(dy, 0), height + min(dy, 0))
+    dst_rows = slice(max(-dy, 0), height + min(-dy, 0))
+    src_cols = slice(max(dx, 0), width + min(dx, 0))
+    dst_cols = slice(max(-dx, 0), width + min(-dx, 0))
+    out[dst_rows, dst_cols] = values[src_rows, src_cols]
+    return out
+
+
+def box_mean(values: np.ndarray, radius: int) -> np.ndarray:
+    # mean over the valid pixels of the (2 * radius + 1) square around each pixel, ee.Kernel.square(radius)
+    valid = ~np.isnan(values)
+    padded = np.pad(np.where(valid, values, 0), radius + 1)[:-1, :-1]
+    counts = np.pad(valid.astype(np.float64), radius + 1)[:-1, :-1]
+    size = 2 * radius + 1
+
+    def window_sums(arr):
+        cumulative = arr.cumsum(axis=0).cumsum(axis=1)
+        return cumulative[size:, size:] - cumulative[:-size, size:] - cumulative[size:, :-size] + \
+            cumulative[:-size, :-size]
+
+    sums, n = window_sums(padded), window_sums(counts)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(n > 0, sums / n, np.nan)
+
+
+def box_max(values: np.ndarray, radius: int) -> np.ndarray:
+    # separable maximum over the (2 * radius + 1) square around each pixel
+    rows = values
+    for dx in range(-radius, radius + 1):
+        if dx:
+            rows = np.fmax(rows, _shifted(values, 0, dx))
+    out = rows
+    for dy in range(-radius, radius + 1):
+        if dy:
+            out = np.fmax(out, _shifted(rows, dy, 0))
+    return out
+
+
+def circle_rows(radius: float) -> list:
+    # (row offset, half width) of the rows of an ee circle kernel, the pixels within radius of the center
+    r = int(math.floor(radius))
+    return [(dy, int(math.floor(math.sqrt(radius ** 2 - dy ** 2)))) for dy in range(-r, r + 1)]
+
+
+def focal(values: np.ndarray, radius: float, func: callable, iterations: int = 1) -> np.ndarray:
+    # focal_min (func np.fmin) or focal_max (np.fmax) with a circle kernel, decomposed into the horizontal runs of
+    # its rows: the running extreme of each distinct half width is computed once and shifted vertically
+    rows = circle_rows(radius)
+    for _ in range(iterations):
+        runs = {}
+        current = values
+        for half_width in range(max(w for _, w in rows) + 1):
+            if half_width:
+                current = func(func(current, _shifted(values, 0, half_width)), _shifted(values, 0, -half_width))
+            runs[half_width] = current
+        out = np.full_like(values, np.nan)
+        for dy, half_width in rows:
+            out = func(out, _shifted(runs[half_width], dy, 0))
+        values = out
+    return values
+
+
+def dilated_erosion(score: np.ndarray, dilation_pixels: float = 3, erode_pixels: float = 1.5) -> np.ndarray:
+    score = focal(score, erode_pixels, np.fmin, iterations=3)
+    return focal(score, dilation_pixels, np.fmax, iterations=3)
+
+
+def _band(scene: dict, name: str) -> np.ndarray:
+    values = np.asarray(scene['bands'][name], dtype=np.float64)
+    if scene.get('valid') is not None:
+        values = np.where(scene['valid'], values, np.nan)
+    return values
+
+
+def cloud_score(scene: dict) -> np.ndarray:
+    # s2toa.compute_cloud_score, whose dilated score does not enter the returned band
+    toa = {name: _band(scene, name) / 10000 for name in ['B1', 'B2', 'B3', 'B4', 'B10']}
+    score = np.ones_like(toa['B2'])
+    score = np.minimum(score, rescale(toa['B2'], [0.1, 0.5]))
+    score = np.minimum(score, rescale(toa['B1'], [0.1, 0.3]))
+    score = np.minimum(score, rescale(toa['B1'] + toa['B10'], [0.15, 0.2]))
+    score = np.minimum(score, rescale(toa['B4'] + toa['B3'] + toa['B2'], [0.2, 0.8]))
+
+    ndmi = normalized_difference(_band(scene, 'B8'), _band(scene, 'B11'))
+    score = np.minimum(score, rescale(ndmi, [-0.1, 0.1]))
+    ndsi = normalized_difference(_band(scene, 'B3'), _band(scene, 'B11'))
+    score = np.minimum(score, rescale(ndsi, [0.8, 0.6]))
+
+    score = np.maximum(score, 0.001)
+    return box_mean(score, 5)
+
+
+def displace(values: np.ndarray, x: float, y: float, scale: float) -> np.ndarray:
+    # ee.Image.displace by a constant displacement of x (east) and y (north) meters with mode='bilinear'
+    dx, dy = x / scale, -y / scale
+    col, row = int(math.floor(dx)), int(math.floor(dy))
+    fx, fy = dx - col, dy - row
+    out = np.zeros_like(values)
+    weight = np.zeros_like(values)
+    for oy, wy in [(row, 1 - fy), (row + 1, fy)]:
+        for ox, wx in [(col, 1 - fx), (col + 1, fx)]:
+            w = wy * wx
+            if w == 0:
+                continue
+            shifted = _shifted(values, oy, ox)
+            valid = ~np.isnan(shifted)
+            out += np.where(valid, shifted, 0) * w
+            weight += valid * w
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(weight > 0, out / weight, np.nan)
+
+
+def sequence(start: float, end: float, step: float) -> np.ndarray:
+    # like ee.List.sequence, start to at most end
+    return start + step * np.arange(int(math.floor((end - start) / step)) + 1)
+
+
+def fine_height_step(zenith: float, shadow_scale: float = 20, shadow_tolerance: float = 9) -> float:
+    # height difference for which the shadow moves by shadow_tolerance pixels of shadow_scale
+    return shadow_tolerance * shadow_scale / math.tan(math.radians(zenith))
+
+
+def min_reduced_step(cloud_heights: list) -> float:
+    # s2toa.min_reduced_step
+    return 2 * (max(cloud_heights) - min(cloud_heights)) / max(len(cloud_heights) - 1, 1)
+
+
+def shadow_heights(zenith: float, cloud_heights: list = CLOUD_HEIGHTS, shadow_mode: str = 'full',
+                   shadow_scale: float = 20, shadow_tolerance: float = 9) -> list:
+    # cloud heights of the 'full' and 'reduced' modes of s2toa.compute_shadow_score
+    if shadow_mode == 'full':
+        return list(cloud_heights)
+    fine_step = max(fine_height_step(zenith, shadow_scale, shadow_tolerance), min_reduced_step(cloud_heights))
+    return list(sequence(min(cloud_heights), max(cloud_heights), fine_step))
+
+
+def shadow_score(scene: dict, cloud: np.ndarray, scale: float, cloud_heights: list = CLOUD_HEIGHTS,
+                 cloud_thresh: float = 0.2, ir_sum_thresh: float = 0.3, ndvi_thresh: float = -0.1,
+                 shadow_mode: str = 'full', shadow_scale: float = 20, shadow_tolerance: float = 9,
+                 coarse_step: float = 1000) -> np.ndarray:
+    # s2toa.compute_shadow_score, the coarse search of 'coarse_to_fine' is evaluated at the chip resolution
+    cloud_mask = cloud > cloud_thresh
+    dark_pixels = (_band(scene, 'B8') + _band(scene, 'B11') + _band(scene, 'B12')) / 10000 < ir_sum_thresh
+    water_mask = normalized_difference(_band(scene, 'B8'), _band(scene, 'B4')) < ndvi_thresh
+    dark_pixel_mask = (dark_pixels & ~water_mask & ~cloud_mask).astype(np.float64)
+    dark_pixel_mask[np.isnan(cloud)] = np.nan
+
+    az_rad = math.radians(scene['MEAN_SOLAR_AZIMUTH_ANGLE'] + 180)
+    zen_rad = math.radians(scene['MEAN_SOLAR_ZENITH_ANGLE'])
+
+    def find_shadows(cloud_height: float) -> np.ndarray:
+        distance = math.tan(zen_rad) * cloud_height
+        return displace(cloud, -math.sin(az_rad) * distance, -math.cos(az_rad) * distance, scale)
+
+    if shadow_mode == 'coarse_to_fine':
+        min_height, max_height = min(cloud_heights), max(cloud_heights)
+        coarse_heights = sequence(min_height, max_height, coarse_step)
+
+        def shadow_match(cloud_height: float) -> float:
+            overlap = find_shadows(cloud_height) * dark_pixel_mask
+            overlap = overlap[~np.isnan(overlap)]
+            return float(overlap.mean()) if overlap.size else 0.
+
+        matches = [shadow_match(height) for height in coarse_heights]
+        best_height = coarse_heights[int(np.argmax(matches))]
+        fine_step = fine_height_step(scene['MEAN_SOLAR_ZENITH_ANGLE'], shadow_scale, shadow_tolerance)
+        heights = sequence(max(best_height - coarse_step / 2, min_height),
+                           min(best_height + coarse_step / 2, max_height), fine_step)
+    else:
+        heights = shadow_heights(scene['MEAN_SOLAR_ZENITH_ANGLE'], cloud_heights, shadow_mode, shadow_scale,
+                                 shadow_tolerance)
+
+    # mean of the displaced cloud scores over the heights, one displaced array in memory at a time
+    total = np.zeros_like(cloud)
+    count = np.zeros_like(cloud)
+    for height in heights:
+        shadows = find_shadows(height)
+        valid = ~np.isnan(shadows)
+        total += np.where(valid, shadows, 0)
+        count += valid
+    with np.errstate(divide='ignore', invalid='ignore'):
+        shadow_mask = np.where(count > 0, total / count, np.nan)
+
+    shadow_mask = dilated_erosion(shadow_mask * dark_pixel_mask)
+    return box_max(shadow_mask, 1)
+
+
+def quality_score(cloud: np.ndarray, shadow: np.ndarray) -> np.ndarray:
+    # s2toa.compute_quality_score
+    return -box_mean(np.maximum(cloud, shadow), 5)
+
+
+def score_scene(scene: dict, scale: float, cloud_thresh: float = 0.2, **shadow_params) -> dict:
+    cloud = cloud_score(scene)
+    shadow = shadow_score(scene, cloud, scale, cloud_thresh=cloud_thresh, **shadow_params)
+    # s2toa.compute_cloud_coverage: cloud area within the chip relative to the area of the whole scene footprint
+    valid = ~np.isnan(cloud)
+    cloud_area = np.count_nonzero(cloud[valid] > cloud_thresh) * scale ** 2
+    cloudy_percentage = 100 * cloud_area / scene['FOOTPRINT_AREA']
+    return {
+        'cloudScore': cloud,
+        'shadowScore': shadow,
+        'cloudShadowScore': quality_score(cloud, shadow),
+        'CLOUDY_PERCENTAGE': cloudy_percentage
+    }
+
+
+def cloud_free_mosaic(scenes, scale: float, bands: list = None, cloud_free_keep_thresh: float = 5,
+                      **shadow_params) -> np.ndarray:
+    """
+    Local s2toa.cloud_free_mosaic of the scenes (any iterable, e.g. a generator loading one chip at a time), returned as
+    (bands, height, width) array. Only the running mosaics are kept in memory: per pixel the scene with the highest
+    cloudShadowScore (qualityMosaic) and the least cloudy scene below cloud_free_keep_thresh, which is on top.
+    """
+    bands = BANDS if bands is None else bands
+    quality, quality_mosaic, best_cloudy, best_mosaic = None, None, None, None
+
+    for scene in scenes:
+        scores = score_scene(scene, scale, **shadow_params)
+        values = np.stack([_band(scene, name) for name in bands])
+        if quality is None:
+            shape = values.shape
+            quality = np.full(shape[1:], -np.inf)
+            quality_mosaic = np.full(shape, np.nan)
+            best_cloudy = np.full(shape[1:], np.inf)
+            best_mosaic = np.full(shape, np.nan)
+
+        score = scores['cloudShadowScore']
+        better = ~np.isnan(score) & (score > quality)
+        quality[better] = score[better]
+        quality_mosaic[:, better] = values[:, better]
+
+        if scores['CLOUDY_PERCENTAGE'] < cloud_free_keep_thresh:
+            covered = ~np.isnan(values).any(axis=0) & (scores['CLOUDY_PERCENTAGE'] < best_cloudy)
+            best_cloudy[covered] = scores['CLOUDY_PERCENTAGE']
+            best_mosaic[:, covered] = values[:, covered]
+
+    if quality is None:
+        raise ValueError('No scenes to mosaic')
+    return np.where(np.isnan(best_mosaic), quality_mosaic, best_mosaic)
+
+
+# ----- validation on synthetic scenes -----
+
+# low clouds for the validation against earth engine, whose shadows stay within the chip (at most 35 pixels of 20 m
+# for the synthetic zenith angles), and a coarse step that still gives several coarse heights
+VALIDATION_CLOUD_HEIGHTS = list(range(20, 420, 20))
+VALIDATION_COARSE_STEP = 100
+# pixels up to which the scores depend on their neighbors: box means of 5 in the cloud and quality scores, the opening
+# (3 iterations of circles of 1.5 and 3 pixels) and box max of 1 in the shadow score
+NEIGHBORHOOD_RADIUS = 5 + 3 * 1 + 3 * 3 + 1 + 5
+# maximum deviations accepted by s2toa_local_validation.py, the server computes in single precision and the cloud area
+# at 10 m (in percentage points for CLOUDY_PERCENTAGE)
+SERVER_TOLERANCES = {'cloudScore': 1e-3, 'shadowScore': 1e-2, 'cloudShadowScore': 1e-2, 'CLOUDY_PERCENTAGE': 1.}
+LOCAL_TOLERANCE = 1e-9
+
+
+def synthetic_scene(shape: tuple = (128, 128), scale: float = 20, seed: int = 0) -> dict:
+    # smooth background with a bright cloud blob and a dark patch, identical to the image of ee_synthetic_scene
+    params = synthetic_params(shape, scale, seed)
+    rows, cols = np.mgrid[0:shape[0], 0:shape[1]]
+    x, y = (cols + 0.5) * scale, -(rows + 0.5) * scale
+    blob = np.exp(-((x - params['cx']) ** 2 + (y - params['cy']) ** 2) / (2 * params['sigma'] ** 2))
+    bands = {name: params['base'][name] + params['cloud'][name] * blob for name in BANDS}
+    # the footprint of the synthetic scene is the chip
+    return {'bands': bands, 'MEAN_SOLAR_AZIMUTH_ANGLE': params['azimuth'],
+            'MEAN_SOLAR_ZENITH_ANGLE': params['zenith'], 'FOOTPRINT_AREA': shape[0] * shape[1] * scale ** 2}
+
+
+def synthetic_params(shape: tuple, scale: float, seed: int) -> dict:
+    rng = np.random.default_rng(seed)
+    height, width = shape[0] * scale, shape[1] * scale
+    return {
+        'cx': float(rng.uniform(0.3, 0.7) * width),
+        'cy': -float(rng.uniform(0.3, 0.7) * height),
+        'sigma': float(rng.uniform(0.05, 0.15) * min(height, width)),
+        'base': {name: float(rng.uniform(300, 1500)) for name in BANDS},
+        'cloud': {name: float(rng.uniform(3000, 6000)) for name in BANDS},
+        'azimuth': float(rng.uniform(120, 200)),
+        'zenith': float(rng.uniform(30, 60))
+    }
+
+
+def ee_synthetic_scene(shape: tuple = (128, 128), scale: float = 20, seed: int = 0, crs: str = 'EPSG:3857'):
+    # server-side counterpart of synthetic_scene in a projection whose origin is the upper left corner of the chip,
+    # earth engine is only imported for the validation so that the local engine works without it
+    import ee
+    params = synthetic_params(shape, scale, seed)
+    proj = ee.Projection(crs).atScale(scale)
+    coords = ee.Image.pixelCoordinates(ee.Projection(crs))
+    blob = coords.expression(
+        'exp(-((x - cx) * (x - cx) + (y - cy) * (y - cy)) / (2 * s * s))',
+        {'x': coords.select('x'), 'y': coords.select('y'), 'cx': params['cx'], 'cy': params['cy'],
+         's': params['sigma']}
+    )
+    bands = [blob.multiply(params['cloud'][name]).add(params['base'][name]).rename(name) for name in BANDS]
+    img = ee.Image.cat(bands).addBands(ee.Image(0).rename('QA60')).reproject(proj)
+    img = img.set({'MEAN_SOLAR_AZIMUTH_ANGLE': params['azimuth'], 'MEAN_SOLAR_ZENITH_ANGLE': params['zenith']})
+    region = ee.Geometry.Rectangle([0, -shape[0] * scale, shape[1] * scale, 0], crs, False)
+    return img, proj, region
+
+
+def validate_with_server(shape: tuple = (160, 160), scale: float = 20, seed: int = 0, shadow_mode: str = 'full',
+                         cloud_heights: list = VALIDATION_CLOUD_HEIGHTS) -> dict:
+    # maximum absolute deviation of the local scores from the earth engine ones for a synthetic scene and the absolute
+    # deviation of its CLOUDY_PERCENTAGE, which selects the scenes of the best overlay of the mosaic. The server
+    # image is clipped to the chip, which is also its footprint, so that both sides mask the same pixels. The
+    # comparison of the scores excludes a margin of the largest shadow displacement plus the neighborhood radius of
+    # the scores, within which every pixel only depends on pixels of the chip
+    import ee
+    import s2toa
+    params = {'shadow_mode': shadow_mode, 'cloud_heights': cloud_heights, 'coarse_step': VALIDATION_COARSE_STEP}
+    img, proj, region = ee_synthetic_scene(shape, scale, seed)
+    img = img.clip(region).set({'system:footprint': region.transform('EPSG:4326', 0.01), 'ROI': region})
+    img = s2toa.compute_cloud_score(img, proj)
+    img = s2toa.compute_cloud_coverage(img)
+    img = s2toa.compute_shadow_score(img, proj=proj, coarse_scale=scale, displace_mode='bilinear', **params)
+    img = s2toa.compute_quality_score(img, proj)
+    names = ['cloudScore', 'shadowScore', 'cloudShadowScore']
+    server = ee.Dictionary(img.select(names).reproject(proj).sampleRectangle(region=region, defaultValue=0)
+                           .toDictionary()).set('CLOUDY_PERCENTAGE', img.get('CLOUDY_PERCENTAGE')).getInfo()
+
+    local = score_scene(synthetic_scene(shape, scale, seed), scale, **params)
+    zenith = synthetic_params(shape, scale, seed)['zenith']
+    displacement = math.tan(math.radians(zenith)) * max(cloud_heights) / scale
+    margin = int(math.ceil(displacement)) + NEIGHBORHOOD_RADIUS
+    if 2 * margin >= min(shape):
+        raise ValueError(f'Chip of {shape} pixels too small for a margin of {margin} pixels')
+    inner = (slice(margin, -margin), slice(margin, -margin))
+    deviations = {name: float(np.nanmax(np.abs(np.array(server[name])[inner] - local[name][inner]))) for name in names}
+    deviations['CLOUDY_PERCENTAGE'] = abs(server['CLOUDY_PERCENTAGE'] - local['CLOUDY_PERCENTAGE'])
+    return deviations
+
+
+def validate_local(shape: tuple = (48, 40), seed: int = 0) -> dict:
+    # deviations of the decomposed neighborhood operations from brute force implementations on random inputs
+    rng = np.random.default_rng(seed)
+    values = rng.random(shape)
+    values[rng.random(shape) < 0.1] = np.nan
+
+    def brute_force(offsets, reduce):
+        stack = np.stack([_shifted(values, dy, dx) for dy, dx in offsets])
+        with np.errstate(all='ignore'):
+            return reduce(stack)
+
+    deviations = {}
+    for radius in [1.5, 3]:
+        offsets = [(dy, dx) for dy, w in circle_rows(radius) for dx in range(-w, w + 1)]
+        for name, func, reduce in [('focal_min', np.fmin, lambda s: np.nanmin(s, axis=0)),
+                                   ('focal_max', np.fmax, lambda s: np.nanmax(s, axis=0))]:
+            deviations[f'{name}_{radius}'] = float(np.nanmax(np.abs(
+                focal(values, radius, func) - brute_force(offsets, reduce))))
+
+    square = [(dy, dx) for dy in range(-5, 6) for dx in range(-5, 6)]
+    deviations['box_mean_5'] = float(np.nanmax(np.abs(
+        box_mean(values, 5) - brute_force(square, lambda s: np.nanmean(s, axis=0)))))
+    square = [(dy, dx) for dy in range(-1, 2) for dx in range(-1, 2)]
+    deviations['box_max_1'] = float(np.nanmax(np.abs(
+        box_max(values, 1) - brute_force(square, lambda s: np.nanmax(s, axis=0)))))
+    return deviations
@@ -0,0 +1,28 @@
+import ee
+
+import s2toa_local
+
+
+if __name__ == '__main__':
+    failures = []
+
+    # the decomposed neighborhood operations against brute force implementations
+    for name, deviation in s2toa_local.validate_local().items():
+        print(f'{name}: max deviation {deviation:.2e}')
+        if deviation > s2toa_local.LOCAL_TOLERANCE:
+            failures.append(name)
+
+    # the local scores against the earth engine definitions of s2toa for synthetic scenes
+    ee.Initialize()
+    n_scenes = 3
+    for seed in range(n_scenes):
+        for mode in ['full', 'reduced', 'coarse_to_fine']:
+            deviations = s2toa_local.validate_with_server(seed=seed, shadow_mode=mode)
+            line = ', '.join(f'{name} {deviation:.4f}' for name, deviation in deviations.items())
+            print(f'scene {seed} {mode}: max deviation {line}')
+            failures.extend(f'scene {seed} {mode} {name}' for name, deviation in deviations.items()
+                            if deviation > s2toa_local.SERVER_TOLERANCES[name])
+
+    if failures:
+        raise SystemExit(f'Deviations above the tolerance: {", ".join(failures)}')
+    print('All deviations within the tolerances')
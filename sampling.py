@@ -1,14 +1,22 @@
 import ee
+import io
+import json
+import math
+import numpy as np
+import urllib.request
+from collections import defaultdict
 
 from download_manager import args
 from download_manager.config import config
 
 import building_footprints
+import ee_cache
+import instrumentation
 import export
+import patch_geometry
 import utils
 
 
-
 def setup(args):
     cfg = config.new_config()
     cfg.merge_from_file(f'configs/{args.config_file}.yaml')
@@ -17,6 +25,25 @@ def setup(args):
     return cfg
 
 
+def get_density_zones(cfg) -> ee.Image:
+
+    building_percentage = building_footprints.get_building_percentage(cfg)
+
+    kernel = ee.Kernel.square(ee.Number(cfg.SAMPLING.NEIGHBORHOOD_SIZE).divide(2))
+    urban_density = building_percentage.reduceNeighborhood(
+        reducer=ee.Reducer.mean(),
+        kernel=kernel,
+        optimization='boxcar'
+    ).rename('urbanDensity')
+
+    density_zones = urban_density.expression(
+        '(d <= 0.00001) ? 0 : (d <= 0.01) ? 1 : (d <= 0.1) ? 2 : 3',
+        {'d': urban_density}
+    ).rename('densityZone')
+
+    return density_zones
+
+
 def density_sampling(cfg) -> ee.FeatureCollection:
 
     bbox = utils.extract_bbox(cfg)
@@ -31,14 +58,14 @@ def density_sampling(cfg) -> ee.FeatureCollection:
     sample_size = ee.Number(ee.Algorithms.If(sample_size.gt(max_sample_size), max_sample_size, sample_size))
     samples_per_class = sample_size.subtract(sample_size.mod(4)).divide(4)
 
-    print(sample_size.getInfo())
-    print(samples_per_class.getInfo())
+    print(ee_cache.get_info(sample_size))
+    print(ee_cache.get_info(samples_per_class))
 
     sampling_region = bbox.buffer(
         distance=ee.Number(cfg.SAMPLING.PATCH_SIZE).multiply(cfg.PIXEL_SPACING).divide(2).multiply(-1),
         proj=cfg.ROI.UTM_EPSG
     )
-    print(sampling_region.getInfo())
+    print(ee_cache.get_info(sampling_region))
 
     # building_footprints = ee.FeatureCollection('users/hafnersailing/Stockholm/real_estate_data') \
     #     .filterBounds(bbox) \
@@ -54,20 +81,7 @@ def density_sampling(cfg) -> ee.FeatureCollection:
     #     .reduceResolution(reducer=ee.Reducer.mean(), maxPixels=1000) \
     #     .rename('buildingPercentage')
 
-    building_percentage = building_footprints.get_building_percentage(cfg)
-
-    # building_percentage = building_footprints.get_building_percentage(cfg)
-    kernel = ee.Kernel.square(ee.Number(cfg.SAMPLING.NEIGHBORHOOD_SIZE).divide(2))
-    urban_density = building_percentage.reduceNeighborhood(
-        reducer=ee.Reducer.mean(),
-        kernel=kernel,
-        optimization='boxcar'
-    ).rename('urbanDensity')
-
-    density_zones = urban_density.expression(
-        '(d <= 0.00001) ? 0 : (d <= 0.01) ? 1 : (d <= 0.1) ? 2 : 3',
-        {'d': urban_density}
-    ).rename('densityZone')
+    density_zones = get_density_zones(cfg)
 
     sampling_points = density_zones.stratifiedSample(
         numPoints=samples_per_class,
@@ -79,9 +93,7 @@ def density_sampling(cfg) -> ee.FeatureCollection:
     )
 
     def point2patch(feature: ee.Feature) -> ee.Feature:
-        point = ee.Feature(feature).geometry().transform(utils.extract_crs(cfg))
-        buffer_distance = patch_size.divide(2).multiply(pixel_spacing).subtract(pixel_spacing.divide(2))
-        patch = point.buffer(distance=buffer_distance, proj=utils.extract_crs(cfg)).bounds(proj=utils.extract_crs(cfg))
+        patch = patch_geometry.ee_patch(cfg, ee.Feature(feature).geometry())
         return ee.Feature(patch).copyProperties(feature)
 
     sampling_patches = sampling_points.map(point2patch)
@@ -90,6 +102,201 @@ def density_sampling(cfg) -> ee.FeatureCollection:
     sampling_patches = sampling_patches.map(lambda f: ee.Feature(f).transform(proj='EPSG:4326', maxError=0.01))
     return sampling_points
 
+
+def sample_sizes(cfg) -> tuple:
+    # same sample size as density_sampling, computed locally
+    patch_area = (cfg.SAMPLING.PATCH_SIZE * cfg.PIXEL_SPACING) ** 2
+    sample_size = int(patch_geometry.roi_area(cfg) / patch_area * cfg.SAMPLING.SAMPLE_FRACTION)
+    sample_size = min(sample_size, cfg.SAMPLING.MAX_SAMPLE_SIZE)
+    samples_per_class = sample_size // 4
+    return sample_size, samples_per_class
+
+
+def zone_grid(cfg) -> dict:
+    # coarse utm grid of the cells completely inside the sampling region, the roi shrunk by half a patch
+    scale = cfg.SAMPLING.ZONE_SCALE
+    d = patch_geometry.half_width(cfg)
+    xmin, ymin, xmax, ymax = patch_geometry.roi_inner_bounds(cfg) + np.array([d, d, -d, -d])
+    x0 = float(np.ceil(xmin / scale) * scale)
+    y0 = float(np.floor(ymax / scale) * scale)
+    return {
+        'x0': x0,
+        'y0': y0,
+        'scale': scale,
+        'n_cols': int(np.floor((xmax - x0) / scale)),
+        'n_rows': int(np.floor((y0 - ymin) / scale))
+    }
+
+
+def zones_file(cfg) -> str:
+    return f'{cfg.PATH}density_zones_{cfg.ROI.ID}.npz'
+
+
+def zones_metadata(cfg, grid: dict) -> dict:
+    # everything the downloaded zones depend on besides the building footprints themselves
+    return {
+        'grid': grid,
+        'crs': cfg.ROI.UTM_EPSG,
+        'pixel_spacing': cfg.PIXEL_SPACING,
+        'neighborhood_size': cfg.SAMPLING.NEIGHBORHOOD_SIZE,
+        'assets': list(cfg.BUILDING_FOOTPRINTS.ASSETS),
+        'pixel_percentage': cfg.BUILDING_FOOTPRINTS.PIXEL_PERCENTAGE
+    }
+
+
+def load_density_zones(cfg, grid: dict) -> np.ndarray:
+    # zones stored by a previous run, None if there are none or they were downloaded with other parameters
+    try:
+        with np.load(zones_file(cfg)) as stored:
+            metadata, zones = json.loads(str(stored['metadata'])), stored['zones']
+    except FileNotFoundError:
+        return None
+    if metadata != json.loads(json.dumps(zones_metadata(cfg, grid))):
+        return None
+    return zones
+
+
+def save_density_zones(cfg, grid: dict, zones: np.ndarray):
+    np.savez(zones_file(cfg), zones=zones, metadata=json.dumps(zones_metadata(cfg, grid)))
+
+
+def download_density_zones(cfg, grid: dict) -> np.ndarray:
+    # density zones of the grid cells with a single download, the neighborhood is still computed at PIXEL_SPACING
+    density_zones = get_density_zones(cfg).reproject(crs=cfg.ROI.UTM_EPSG, scale=cfg.PIXEL_SPACING)
+    url = density_zones.toByte().getDownloadURL({
+        'bands': ['densityZone'],
+        'crs': cfg.ROI.UTM_EPSG,
+        'crs_transform': [grid['scale'], 0, grid['x0'], 0, -grid['scale'], grid['y0']],
+        'dimensions': f'{grid["n_cols"]}x{grid["n_rows"]}',
+        'format': 'NPY'
+    })
+    with urllib.request.urlopen(url) as response:
+        zones = np.load(io.BytesIO(response.read()))['densityZone']
+    return np.asarray(zones, dtype=np.uint8)
+
+
+class SpatialHash(object):
+    """
+    Accepted points hashed into square cells of the minimum spacing, so that a candidate only has to be compared
+    with the points in the 3 x 3 cells around it. Distances are measured along the axes (chebyshev distance) since
+    two square patches overlap if both their x and their y distance are below the patch width.
+    """
+    def __init__(self, spacing: float):
+        self.spacing = spacing
+        self._cells = defaultdict(list)
+
+    def _cell(self, x: float, y: float) -> tuple:
+        return int(math.floor(x / self.spacing)), int(math.floor(y / self.spacing))
+
+    def is_free(self, x: float, y: float) -> bool:
+        col, row = self._cell(x, y)
+        for i in (-1, 0, 1):
+            for j in (-1, 0, 1):
+                for px, py in self._cells.get((col + i, row + j), []):
+                    if max(abs(px - x), abs(py - y)) < self.spacing:
+                        return False
+        return True
+
+    def add(self, x: float, y: float):
+        self._cells[self._cell(x, y)].append((x, y))
+
+
+def min_spacing(cfg) -> float:
+    # minimum distance between points in meters, SAMPLING.MIN_SPACING is given in patch widths
+    return cfg.SAMPLING.MIN_SPACING * cfg.SAMPLING.PATCH_SIZE * cfg.PIXEL_SPACING
+
+
+def duplicate_area(cfg, points: list, resolution: int = 32) -> float:
+    # export area in square meters paid more than once due to overlapping patches, the patches are rasterized at
+    # 1 / resolution of their width
+    if not points:
+        return 0.
+    width = cfg.SAMPLING.PATCH_SIZE * cfg.PIXEL_SPACING
+    pixel = width / resolution
+    xy = np.array([[x, y] for x, y, _ in points])
+    origin = xy.min(axis=0) - width / 2
+    cols, rows = np.ceil((xy.max(axis=0) + width / 2 - origin) / pixel).astype(int) + 1
+    covered = np.zeros((rows, cols), dtype=bool)
+    for col, row in np.floor((xy - width / 2 - origin) / pixel).astype(int):
+        covered[row:row + resolution, col:col + resolution] = True
+    return len(points) * width ** 2 - np.count_nonzero(covered) * pixel ** 2
+
+
+def draw_spaced_points(cfg, zones: np.ndarray, grid: dict, samples_per_class: int, spacing: float) -> list:
+    # poisson-disk style variant of draw_points: the cells of each zone are visited in random order and a point is
+    # only accepted at least spacing away from all accepted points, until the quota of the zone is met. The built-up
+    # zones pick first, those with fewer cells before the common ones so that they are not crowded out, and zone 0
+    # (no buildings) last, so that its patches never displace patches with buildings
+    rng = np.random.default_rng(cfg.SAMPLING.SEED)
+    pixels_per_cell = max(int(round(grid['scale'] / cfg.PIXEL_SPACING)), 1)
+    index = SpatialHash(spacing)
+    cells = {zone: np.flatnonzero(zones.ravel() == zone) for zone in range(4)}
+
+    points = []
+    for zone in sorted(cells, key=lambda z: (z == 0, cells[z].size)):
+        n = 0
+        for cell in rng.permutation(cells[zone]):
+            if n == samples_per_class:
+                break
+            row, col = divmod(int(cell), grid['n_cols'])
+            offset_x, offset_y = (rng.integers(0, pixels_per_cell, size=2) + 0.5) * cfg.PIXEL_SPACING
+            x = grid['x0'] + col * grid['scale'] + offset_x
+            y = grid['y0'] - row * grid['scale'] - offset_y
+            if index.is_free(x, y):
+                index.add(x, y)
+                points.append((x, y, zone))
+                n += 1
+        if n < samples_per_class:
+            print(f'Only {n} of {samples_per_class} points of density zone {zone} fit the minimum spacing')
+    return points
+
+
+def draw_points(cfg, zones: np.ndarray, grid: dict, samples_per_class: int) -> list:
+    # stratified draw of samples_per_class cells per zone without replacement, seeded with SAMPLING.SEED. Each point
+    # is placed at the center of a random PIXEL_SPACING pixel of its cell, returns (x, y, zone) utm points
+    rng = np.random.default_rng(cfg.SAMPLING.SEED)
+    pixels_per_cell = max(int(round(grid['scale'] / cfg.PIXEL_SPACING)), 1)
+    points = []
+    for zone in range(4):
+        cells = np.flatnonzero(zones.ravel() == zone)
+        chosen = rng.choice(cells, size=min(samples_per_class, cells.size), replace=False)
+        rows, cols = np.divmod(chosen, grid['n_cols'])
+        offsets = (rng.integers(0, pixels_per_cell, size=(chosen.size, 2)) + 0.5) * cfg.PIXEL_SPACING
+        x = grid['x0'] + cols * grid['scale'] + offsets[:, 0]
+        y = grid['y0'] - rows * grid['scale'] - offsets[:, 1]
+        points.extend(zip(x, y, [zone] * chosen.size))
+    return points
+
+
+def local_density_sampling(cfg) -> list:
+    # local counterpart of density_sampling, the downloaded zones are kept in PATH for reruns
+    _, samples_per_class = sample_sizes(cfg)
+    grid = zone_grid(cfg)
+    zones = load_density_zones(cfg, grid)
+    if zones is None:
+        zones = download_density_zones(cfg, grid)
+        save_density_zones(cfg, grid, zones)
+
+    points = draw_points(cfg, zones, grid, samples_per_class)
+    spacing = min_spacing(cfg)
+    if spacing > 0:
+        # duplicate export area of the points with and without the minimum spacing
+        unspaced_duplicates = duplicate_area(cfg, points)
+        points = draw_spaced_points(cfg, zones, grid, samples_per_class, spacing)
+        duplicates = duplicate_area(cfg, points)
+        print(f'Duplicate export area: {unspaced_duplicates / 1e6:.2f} km2 without minimum spacing, '
+              f'{duplicates / 1e6:.2f} km2 with it, {(unspaced_duplicates - duplicates) / 1e6:.2f} km2 saved')
+    coords = patch_geometry.unproject(cfg, np.array([[x, y] for x, y, _ in points]).reshape(-1, 2))
+    return [{'type': 'Feature', 'geometry': {'type': 'Point', 'coordinates': [float(lng), float(lat)]},
+             'properties': {'densityZone': int(zone)}} for (lng, lat), (_, _, zone) in zip(coords, points)]
+
+
+def write_points(cfg, features: list):
+    # points file in the location gee_download reads it from
+    with open(f'{cfg.PATH}points_{cfg.ROI.ID}.geojson', 'w') as f:
+        json.dump({'type': 'FeatureCollection', 'features': features}, f)
+
+
 if __name__ == '__main__':
     # setting up config based on parsed argument
     parser = args.argument_parser()
@@ -97,11 +304,22 @@ if __name__ == '__main__':
     cfg = setup(args)
 
     ee.Initialize()
+    ee_cache.configure(cfg)
+    instrumentation.configure(cfg)
+
+    if cfg.SAMPLING.LOCAL:
+        with instrumentation.stage('sampling'):
+            features = local_density_sampling(cfg)
+        write_points(cfg, features)
+        print(f'{len(features)} points written to {cfg.PATH}points_{cfg.ROI.ID}.geojson')
+    else:
+        with instrumentation.stage('sampling'):
+            sampling_patches = density_sampling(cfg)
 
-    sampling_patches = density_sampling(cfg)
+        task = export.table_to_drive(fc=sampling_patches, folder='gee_test_exports',
+                                     file_name=f'points_{cfg.ROI.ID}')
+        task.start()
 
-    task = export.table_to_drive(fc=sampling_patches, folder='gee_test_exports',
-                                 file_name=f'points_{cfg.ROI.ID}')
-    task.start()
+    instrumentation.write_summary(cfg)
 
 
@@ -1,6 +1,7 @@
 import ee
 import utils
 import s2toa
+import sentinel1
 
 
 def s2_bands(key: str):
@@ -23,23 +24,58 @@ def load_filters(record: dict):
     return []
 
 
+# products by (sensor, product), each builds the composite of a record on which band subsets and normalizations are
+# applied afterwards
+PRODUCTS = {}
+
+# record keys only applied to the composite, records that differ in these keys only share the composite
+DERIVED_KEYS = ['SENSOR', 'PRODUCT', 'BANDS', 'NORMALIZE']
+
+
+def register_product(sensor: str, product: str, bands: callable = None, normalize: callable = None) -> callable:
+    # bands maps the BANDS entry of a record to the band names selected from the composite, normalize maps the
+    # composite to [0, 1] for records with NORMALIZE, products without it are never normalized
+    def decorator(func: callable) -> callable:
+        PRODUCTS[(sensor, product)] = {'func': func, 'bands': bands, 'normalize': normalize}
+        return func
+    return decorator
+
+
+@register_product('s2toa', 'cloud_free_mosaic', bands=s2_bands, normalize=utils.normalize(0, 10000))
+def s2toa_cloud_free_mosaic(params: dict, roi: ee.Geometry, date_range) -> ee.Image:
+    return s2toa.cloud_free_mosaic(roi, date_range, shadow_mode=params.get('SHADOW_MODE', 'full'),
+                                   max_candidates=params.get('MAX_CANDIDATES', 0),
+                                   working_crs=params.get('WORKING_CRS', None),
+                                   working_scale=params.get('WORKING_SCALE', 20))
+
+
+@register_product('s1', 'time_series_features')
+def s1_time_series_features(params: dict, roi: ee.Geometry, date_range) -> ee.Image:
+    return sentinel1.get_time_series_features(roi, date_range.start(), date_range.end(),
+                                              params.get('ORBIT_NUMBERS', None), params['POLARIZATIONS'],
+                                              params['ORBITS'], params['METRICS'], params.get('INCLUDE_COUNT', False))
+
+
+# composites are built once per sensor, product, parameters, roi and date range
+@utils.memoize_graph()
+def product_image(sensor: str, product: str, params: dict, roi: ee.Geometry, date_range) -> ee.Image:
+    return PRODUCTS[(sensor, product)]['func'](params, roi, date_range)
+
+
 def process_record(record: dict, roi: ee.Geometry, date_range) -> ee.Image:
     # getting satellite data for record setting
-    # TODO: put functions in dictionary
-    img = ee.Image(1)
-    if record['SENSOR'] == 's2sr':
-        pass
-
-    if record['SENSOR'] == 's2toa':
-        if record['PRODUCT'] == 'cloud_free_mosaic':
-            img = s2toa.cloud_free_mosaic(roi, date_range)
-            img = img.select(s2_bands(record['BANDS']))
-            if record['NORMALIZE'] is True:
-                img = img.divide(10000).clamp(0, 1).float()
-
-    if record['SENSOR'] == 's1':
-        # TODO: implement s1
-        pass
+    product = PRODUCTS.get((record['SENSOR'], record.get('PRODUCT')))
+    if product is None:
+        return ee.Image(1)
+
+    params = {key: value for key, value in record.items() if key not in DERIVED_KEYS}
+    img = product_image(record['SENSOR'], record['PRODUCT'], params, roi, date_range)
+
+    if product['bands'] is not None and 'BANDS' in record:
+        img = img.select(product['bands'](record['BANDS']))
+    if product['normalize'] is not None and record.get('NORMALIZE') is True:
+        # the mappers end in copyProperties, which returns an ee.Element
+        img = ee.Image(product['normalize'](img)).float()
 
     return img
 
@@ -0,0 +1,153 @@
+import ee
+import heapq
+import itertools
+import threading
+
+# states after which a task is no longer tracked: finished tasks, tasks being cancelled and task ids the backend does
+# not know (e.g. stale ids of an old run), which would otherwise stay in flight forever
+TERMINAL_STATES = ['COMPLETED', 'FAILED', 'CANCELLED', 'CANCEL_REQUESTED', 'UNKNOWN']
+
+
+class ExportScheduler(object):
+    """
+    Releases export tasks to earth engine while keeping the number of in-flight tasks below a bounded window.
+
+    Queued tasks are started in priority order (lower value first, ties in submission order) whenever earlier tasks
+    reach a terminal state. The states of all in-flight tasks are polled in a single request, the polling interval
+    backs off exponentially while nothing changes or requests fail and resets as soon as a task finishes. Tasks that
+    cannot be started are retried up to max_start_attempts times before they are reported as FAILED.
+    """
+    def __init__(self, max_in_flight: int = 100, poll_interval: float = 10, max_poll_interval: float = 120,
+                 backoff: float = 2, on_state_change: callable = None, max_start_attempts: int = 5):
+        self.max_in_flight = max_in_flight
+        self.max_start_attempts = max_start_attempts
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.backoff = backoff
+        self.on_state_change = on_state_change
+
+        self._queue = []
+        self._counter = itertools.count()
+        self._in_flight = {}
+        self._states = {}
+        self._start_attempts = {}
+        self._closed = False
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def submit(self, task: ee.batch.Task, priority: int = 0, key=None):
+        # key is handed back to on_state_change to identify the task
+        with self._lock:
+            heapq.heappush(self._queue, (priority, next(self._counter), task, key))
+            # starting new tasks right away rather than after the current polling interval if there is room
+            if len(self._in_flight) < self.max_in_flight:
+                self._wakeup.set()
+
+    def attach(self, task: ee.batch.Task, key=None):
+        # registering an already started task so that it counts towards the in-flight window
+        with self._lock:
+            self._in_flight[task.id] = (task, key)
+
+    def close(self):
+        # no more tasks will be submitted, run returns once everything is finished
+        with self._lock:
+            self._closed = True
+        self._wakeup.set()
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run, daemon=True)
+        self._thread.start()
+
+    def join(self):
+        self.close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def run(self):
+        interval = self.poll_interval
+        while True:
+            self._release()
+            with self._lock:
+                if self._closed and not self._queue and not self._in_flight:
+                    return
+            woken = self._wakeup.wait(interval)
+            self._wakeup.clear()
+            if woken:
+                continue
+            try:
+                n_finished = self._poll()
+            except Exception as e:
+                # transient failures of the status request are retried after the backed off interval
+                print(f'Failed to poll task states: {e}')
+                n_finished = 0
+            if n_finished > 0:
+                interval = self.poll_interval
+            else:
+                interval = min(interval * self.backoff, self.max_poll_interval)
+
+    def _release(self):
+        while True:
+            with self._lock:
+                if not self._queue or len(self._in_flight) >= self.max_in_flight:
+                    return
+                priority, count, task, key = heapq.heappop(self._queue)
+            try:
+                task.start()
+            except Exception as e:
+                # the backend refused the task (e.g. too many queued tasks) or the request failed, retry it after the
+                # next poll unless it failed too often
+                print(f'Failed to start task: {e}')
+                attempts = self._start_attempts.get(count, 0) + 1
+                self._start_attempts[count] = attempts
+                if attempts >= self.max_start_attempts:
+                    self._update_state(task, key, 'FAILED')
+                    continue
+                with self._lock:
+                    heapq.heappush(self._queue, (priority, count, task, key))
+                return
+            self._start_attempts.pop(count, None)
+            with self._lock:
+                self._in_flight[task.id] = (task, key)
+            self._update_state(task, key, 'READY')
+
+    def _poll(self) -> int:
+        with self._lock:
+            in_flight = dict(self._in_flight)
+        if not in_flight:
+            return 0
+
+        statuses = ee.data.getTaskStatus(list(in_flight.keys()))
+
+        n_finished = 0
+        for status in statuses:
+            if status['id'] not in in_flight:
+                continue
+            task, key = in_flight[status['id']]
+            state = status['state']
+            self._update_state(task, key, state)
+            if state in TERMINAL_STATES:
+                if state == 'FAILED':
+                    print(f'Task {task.id} failed: {status.get("error_message")}')
+                with self._lock:
+                    del self._in_flight[task.id]
+                n_finished += 1
+        return n_finished
+
+    def _update_state(self, task: ee.batch.Task, key, state: str):
+        # tasks that never started have no id yet
+        task_key = task.id if task.id is not None else id(task)
+        if self._states.get(task_key) == state:
+            return
+        self._states[task_key] = state
+        if self.on_state_change is not None:
+            self.on_state_change(key, task, state)
+
+
+def from_config(cfg, on_state_change: callable = None) -> ExportScheduler:
+    return ExportScheduler(
+        max_in_flight=cfg.DOWNLOAD.MAX_IN_FLIGHT,
+        poll_interval=cfg.DOWNLOAD.POLL_INTERVAL,
+        max_poll_interval=cfg.DOWNLOAD.MAX_POLL_INTERVAL,
+        on_state_change=on_state_change
+    )
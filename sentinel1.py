@@ -11,7 +11,35 @@ def get_feature_names(polarizations: list, orbits: list, metrics: list):
     return names
 
 
-# retrieve sentinel-2 data for city
+def metric_reducer(metrics: list) -> ee.Reducer:
+    # all metrics (mean, median, stdDev, min, max, count and percentiles like p10) as one combined reducer whose
+    # outputs are named {band}_{metric}, percentiles share a single percentile reducer
+    reducers = {
+        'mean': ee.Reducer.mean,
+        'median': ee.Reducer.median,
+        'stdDev': ee.Reducer.stdDev,
+        'min': ee.Reducer.min,
+        'max': ee.Reducer.max,
+        'count': ee.Reducer.count
+    }
+    percentiles = [int(metric[1:]) for metric in metrics if metric not in reducers]
+    combined = [reducers[metric]() for metric in metrics if metric in reducers]
+    if percentiles:
+        combined.append(ee.Reducer.percentile(percentiles))
+
+    reducer = combined[0]
+    for other in combined[1:]:
+        reducer = reducer.combine(reducer2=other, sharedInputs=True)
+    return reducer
+
+
+def compute_time_series_metrics(time_series: ee.ImageCollection, polarizations: list, metrics: list) -> ee.Image:
+    # bands {pol}_{metric} in the order of polarizations and metrics
+    names = [f'{pol}_{metric}' for pol in polarizations for metric in metrics]
+    return time_series.select(polarizations).reduce(metric_reducer(metrics)).select(names)
+
+
+# retrieve sentinel-1 data for city
 def get_time_series_features(bbox: ee.Geometry, from_date: str, to_date: str, orbit_numbers: dict,
                              polarizations: list, orbits: list, metrics: list, include_count: bool = False) -> ee.Image:
 
@@ -33,26 +61,30 @@ def get_time_series_features(bbox: ee.Geometry, from_date: str, to_date: str, or
     # rescaling from [-25, 5] to [0, 1]
     s1 = s1.map(lambda img: img.unitScale(-25, 5).clamp(0, 1).copyProperties(img))
 
-    # getting features for both orbits
+    # getting features for the selected orbits
     features = []
     for orbit in ['ASCENDING', 'DESCENDING']:
+        orbit_key = 'asc' if orbit == 'ASCENDING' else 'desc'
+        if orbit_key not in orbits:
+            continue
         time_series_orbit = s1.filterMetadata('orbitProperties_pass', 'equals', orbit)
 
-        # separating time series according to selected orbit numbers
-        orbit_key = 'asc' if orbit == 'ASCENDING' else 'desc'
-        if len(orbit_numbers.get(orbit_key)) > 0:
-            orbit_features = []
-            for orbit_number in orbit_numbers.get(orbit_key):
-                time_series_single_orbit = s1.filterMetadata('relativeOrbitNumber_start', 'equals', orbit_number)
-                print(f'Number of Sentinel-1 scenes ({orbit_key}): {time_series_single_orbit.size().getInfo()}')
-                features_single_orbit = compute_time_series_metrics(time_series_single_orbit, polarizations, metrics)
-                orbit_features.append(features_single_orbit)
-            orbit_features = ee.ImageCollection(orbit_features).mosaic()
+        # separating time series according to selected orbit numbers (all orbit numbers of the pass if not given),
+        # the metrics of each orbit number are computed server-side in a single pass of the combined reducer
+        if orbit_numbers is None or orbit_numbers.get(orbit_key) is None:
+            numbers = time_series_orbit.aggregate_array('relativeOrbitNumber_start').distinct()
         else:
-            orbit_features = ee.Image.cat(len(polarizations) * len(metrics) * [ee.Image(0)])
+            numbers = ee.List(list(orbit_numbers.get(orbit_key)))
+        orbit_features = numbers.map(lambda number: compute_time_series_metrics(
+            time_series_orbit.filterMetadata('relativeOrbitNumber_start', 'equals', number), polarizations, metrics
+        ))
 
-        # including orbit in feature names
+        # orbits without scenes end up as zeros like the masked pixels
         old_names = [f'{pol}_{metric}' for pol in polarizations for metric in metrics]
+        empty = ee.Image.constant(len(old_names) * [0]).rename(old_names)
+        orbit_features = ee.ImageCollection([empty]).merge(ee.ImageCollection.fromImages(orbit_features)).mosaic()
+
+        # including orbit in feature names
         new_names = [f'{pol}_{orbit_key}_{metric}' for pol in polarizations for metric in metrics]
         orbit_features = orbit_features.select(old_names, new_names)
 
@@ -62,6 +94,6 @@ def get_time_series_features(bbox: ee.Geometry, from_date: str, to_date: str, or
     features = features.select(get_feature_names(polarizations, orbits, metrics))
 
     if include_count:
-        features = features.addBands(s1.reduce(ee.Reducer.count()).rename('count'))
+        features = features.addBands(s1.select(polarizations[0]).reduce(ee.Reducer.count()).rename('count'))
 
     return features.unmask().float()
@@ -1,4 +1,5 @@
 import ee
+import ee_cache
 import utils
 import math
 
@@ -92,10 +93,10 @@ def s2toa_collection(bbox: ee.Geometry, date_range: tuple, include_bands: str,
 
 def simple_cloud_mosaicking(collection: ee.ImageCollection) -> ee.Image:
 
-    print(collection.size().getInfo())
+    print(ee_cache.get_info(collection.size()))
     quality_property = 'CLOUDY_PIXEL_PERCENTAGE'
     sorted_collection = collection.sort(quality_property, opt_ascending=False)
-    print(collection.size().getInfo())
+    print(ee_cache.get_info(collection.size()))
     mosaic = sorted_collection.mosaic().float()
 
     return mosaic
@@ -0,0 +1,47 @@
+import ee
+
+from download_manager import args
+from download_manager.config import config
+
+import ee_cache
+import s2toa
+import utils
+
+
+def setup(args):
+    cfg = config.new_config()
+    cfg.merge_from_file(f'configs/{args.config_file}.yaml')
+    cfg.merge_from_list(args.opts)
+    cfg.NAME = args.config_file
+    return cfg
+
+
+if __name__ == '__main__':
+    # setting up config based on parsed argument
+    parser = args.argument_parser()
+    args = parser.parse_known_args()[0]
+    cfg = setup(args)
+
+    ee.Initialize()
+    ee_cache.configure(cfg)
+
+    # comparing the shadow masks of the cheaper shadow modes with the full projection for the cloudiest scenes of the
+    # roi that still show enough ground for shadows
+    roi = utils.extract_bbox(cfg)
+    date_range = utils.extract_date_range(cfg)
+    n_scenes = 5
+
+    scenes = ee.ImageCollection('COPERNICUS/S2') \
+        .filterDate(date_range.start(), date_range.end()) \
+        .filterBounds(roi) \
+        .filterMetadata('CLOUDY_PIXEL_PERCENTAGE', 'less_than', 60) \
+        .sort('CLOUDY_PIXEL_PERCENTAGE', False)
+    scenes = scenes.toList(n_scenes)
+
+    for i in range(n_scenes):
+        scene = ee.Image(scenes.get(i))
+        stats = ee_cache.get_info(s2toa.compare_shadow_modes(scene, roi), use_cache=False)
+        scene_id = ee_cache.get_info(scene.get('system:index'))
+        for mode, mode_stats in stats.items():
+            print(f'{scene_id} {mode}: agreement {mode_stats["agreement"]:.4f}, iou {mode_stats["iou"]:.4f}, '
+                  f'{mode_stats["heights"]} heights')
@@ -1,4 +1,5 @@
 import ee
+import numpy as np
 
 """
 normalizedDifference(bandNames)
@@ -8,6 +9,17 @@ forced to 0 so that the result is confined to the range (-1, 1).
 """
 
 
+# bands of the normalized differences (first - second) / (first + second)
+INDEX_BANDS = {
+    'NDBI': ('SWIR1', 'NIR'),
+    'MNDWI': ('Green', 'NIR'),
+    'NDVI': ('NIR', 'Red'),
+    'NDMIR': ('SWIR1', 'SWIR2'),
+    'NDRB': ('Red', 'Blue'),
+    'NDGB': ('Green', 'Blue')
+}
+
+
 def get_spectral_index_func(spectral_index):
     spectral_index_functions = {
         'NDBI': NDBI,
@@ -59,4 +71,42 @@ def NDRB(img):
 def NDGB(img):
     img = ee.Image(img)
     ndgb = img.normalizedDifference(['Green', 'Blue']).rename('NDGB')
-    return img.addBands(ndgb)
\ No newline at end of file
+    return img.addBands(ndgb)
+
+
+# All indices as one band-wise normalized difference and a single addBands. Like normalizedDifference negative
+# inputs are forced to 0, pixels where both inputs are 0 are 0. Their sum is replaced by 1 there since a division by
+# 0 would mask them. The bands are selected under the index names, a band can be an input of several indices
+def add_indices(img, indices: list):
+    img = ee.Image(img)
+    first = img.select([INDEX_BANDS[index][0] for index in indices], indices).max(0)
+    second = img.select([INDEX_BANDS[index][1] for index in indices], indices).max(0)
+    total = first.add(second)
+    nd = first.subtract(second).divide(total.where(total.eq(0), 1))
+    return img.addBands(nd)
+
+
+# Local counterpart of add_indices for downloaded (bands, height, width) arrays. The indices are written to out (a new
+# float32 array if not given) in chunks of rows, only two chunk-sized buffers are allocated
+def compute_indices(arr: np.ndarray, band_names: list, indices: list, out: np.ndarray = None,
+                    chunk_rows: int = 256) -> np.ndarray:
+    height, width = arr.shape[1:]
+    if out is None:
+        out = np.empty((len(indices), height, width), dtype=np.float32)
+    first = np.empty((chunk_rows, width), dtype=np.float32)
+    second = np.empty((chunk_rows, width), dtype=np.float32)
+
+    for start in range(0, height, chunk_rows):
+        rows = slice(start, min(start + chunk_rows, height))
+        n = rows.stop - rows.start
+        a, b = first[:n], second[:n]
+        for k, index in enumerate(indices):
+            first_band, second_band = INDEX_BANDS[index]
+            np.maximum(arr[band_names.index(first_band), rows], 0, out=a, casting='unsafe')
+            np.maximum(arr[band_names.index(second_band), rows], 0, out=b, casting='unsafe')
+            result = out[k, rows]
+            np.subtract(a, b, out=result)
+            np.add(a, b, out=a)
+            np.divide(result, a, out=result, where=a != 0)
+            result[a == 0] = 0
+    return out
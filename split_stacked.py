@@ -0,0 +1,47 @@
+from pathlib import Path
+
+import rasterio
+
+from download_manager import args
+from download_manager.config import config
+
+import export
+
+
+def setup(args):
+    cfg = config.new_config()
+    cfg.merge_from_file(f'configs/{args.config_file}.yaml')
+    cfg.merge_from_list(args.opts)
+    cfg.NAME = args.config_file
+    return cfg
+
+
+def split_file(file: Path, manifest: dict, out_dir: Path) -> list:
+    # writes one GeoTIFF per sensor named like the separate exports, e.g. stacked_x_patch1 -> sentinel1_x_patch1
+    files = []
+    with rasterio.open(file) as src:
+        profile = src.profile
+        for sensor, (start, stop) in manifest['sensors'].items():
+            sensor_file = out_dir / sensor / file.name.replace('stacked_', f'{sensor}_', 1)
+            sensor_file.parent.mkdir(parents=True, exist_ok=True)
+
+            profile.update(count=stop - start)
+            with rasterio.open(sensor_file, 'w', **profile) as dst:
+                # rasterio band indices start at 1
+                dst.write(src.read(list(range(start + 1, stop + 1))))
+                dst.descriptions = tuple(manifest['bands'][start:stop])
+            files.append(sensor_file)
+    return files
+
+
+if __name__ == '__main__':
+    # setting up config based on parsed argument
+    parser = args.argument_parser()
+    args = parser.parse_known_args()[0]
+    cfg = setup(args)
+
+    # splitting the downloaded stacked exports of the roi into the layout of the separate exports
+    manifest = export.load_manifest(cfg)
+    roi_dir = Path(f'{cfg.PATH}{export.patch_dir(cfg)}')
+    for file in sorted((roi_dir / 'stacked').glob('stacked_*.tif')):
+        split_file(file, manifest, roi_dir)
@@ -0,0 +1,111 @@
+import ee
+import json
+import numpy as np
+
+import patch_geometry
+
+
+def roi_patch_id(cfg) -> str:
+    # patch under which the whole-roi exports are recorded in the journal, which snapped patches share across rois
+    return f'{cfg.ROI.ID}_roi'
+
+
+def roi_grid(cfg) -> dict:
+    # pixel grid in the utm zone covering the roi, its origin and extent are multiples of the patch size so that the
+    # shards of a tiled export coincide with a fixed tiling of the utm zone
+    # the edges of the lng/lat box are curved in utm, so they are densified before taking the bounds
+    edges = np.concatenate(list(patch_geometry.roi_edges(cfg).values()))
+    xmin, ymin, xmax, ymax = patch_geometry.polygon_bounds(edges)[0]
+
+    tile_size = cfg.SAMPLING.PATCH_SIZE * cfg.PIXEL_SPACING
+    x0 = np.floor(xmin / tile_size) * tile_size
+    y0 = np.ceil(ymax / tile_size) * tile_size
+    n_tile_cols = int(np.ceil((xmax - x0) / tile_size))
+    n_tile_rows = int(np.ceil((y0 - ymin) / tile_size))
+
+    grid = {
+        'x0': float(x0),
+        'y0': float(y0),
+        'spacing': cfg.PIXEL_SPACING,
+        'tile_size': cfg.SAMPLING.PATCH_SIZE,
+        'n_cols': n_tile_cols * cfg.SAMPLING.PATCH_SIZE,
+        'n_rows': n_tile_rows * cfg.SAMPLING.PATCH_SIZE
+    }
+    return grid
+
+
+def grid_bounds(grid: dict) -> np.ndarray:
+    xmax = grid['x0'] + grid['n_cols'] * grid['spacing']
+    ymin = grid['y0'] - grid['n_rows'] * grid['spacing']
+    return np.array([grid['x0'], ymin, xmax, grid['y0']])
+
+
+def crs_transform(grid: dict) -> list:
+    return [grid['spacing'], 0, grid['x0'], 0, -grid['spacing'], grid['y0']]
+
+
+def plan(cfg, patches: np.ndarray) -> str:
+    # 'tiled' if one sharded export of the whole roi is cheaper than exporting each sampled patch, costs are measured
+    # in patch areas, every task adding DOWNLOAD.TASK_OVERHEAD patch areas on top of the exported area
+    mode = cfg.DOWNLOAD.EXPORT_MODE
+    if mode not in ['patches', 'tiled', 'auto']:
+        raise ValueError(f'Unknown export mode {mode}')
+    if mode != 'auto':
+        return mode
+
+    grid = roi_grid(cfg)
+    n_tiles = (grid['n_cols'] // grid['tile_size']) * (grid['n_rows'] // grid['tile_size'])
+    overhead = cfg.DOWNLOAD.TASK_OVERHEAD
+
+    patches_cost = len(patches) * (1 + overhead)
+    tiled_cost = n_tiles + overhead
+    print(f'Sampled patch area: {len(patches)} patches, roi area: {n_tiles} patches')
+    return 'tiled' if tiled_cost < patches_cost else 'patches'
+
+
+def tile_file_suffix(row_offset: int, col_offset: int) -> str:
+    # earth engine appends the pixel offsets of each shard to the file name prefix
+    return f'-{row_offset:010d}-{col_offset:010d}'
+
+
+def build_index(grid: dict, patches: np.ndarray) -> dict:
+    # maps each sampled patch to its pixel window in the roi grid and to the windows of the tiles it is made of
+    spacing, tile_size = grid['spacing'], grid['tile_size']
+    row_offsets = np.round((grid['y0'] - patches[:, 3]) / spacing).astype(int)
+    col_offsets = np.round((patches[:, 0] - grid['x0']) / spacing).astype(int)
+    heights = np.round((patches[:, 3] - patches[:, 1]) / spacing).astype(int)
+    widths = np.round((patches[:, 2] - patches[:, 0]) / spacing).astype(int)
+
+    entries = []
+    for i, (row, col, height, width) in enumerate(zip(row_offsets, col_offsets, heights, widths)):
+        tiles = []
+        for tile_row in range(row // tile_size * tile_size, row + height, tile_size):
+            for tile_col in range(col // tile_size * tile_size, col + width, tile_size):
+                # intersection of the patch window with the tile, in tile pixels and in patch pixels
+                r0, r1 = max(row, tile_row), min(row + height, tile_row + tile_size)
+                c0, c1 = max(col, tile_col), min(col + width, tile_col + tile_size)
+                tiles.append({
+                    'file_suffix': tile_file_suffix(tile_row, tile_col),
+                    'tile_window': [int(r0 - tile_row), int(c0 - tile_col), int(r1 - r0), int(c1 - c0)],
+                    'patch_window': [int(r0 - row), int(c0 - col), int(r1 - r0), int(c1 - c0)]
+                })
+        entries.append({
+            'patch': i + 1,
+            'window': [int(row), int(col), int(height), int(width)],
+            'tiles': tiles
+        })
+
+    return {'grid': grid, 'patches': entries}
+
+
+def index_file(cfg) -> str:
+    return f'{cfg.PATH}tile_index_{cfg.ROI.ID}.json'
+
+
+def write_index(cfg, index: dict):
+    with open(index_file(cfg), 'w') as f:
+        json.dump(index, f)
+
+
+def grid_geometry(cfg, grid: dict) -> ee.Geometry:
+    return patch_geometry.bounds_to_geometry(cfg, grid_bounds(grid))
@@ -1,4 +1,10 @@
 import ee
+import hashlib
+import json
+import threading
+from functools import wraps
+
+import patch_geometry
 
 
 def extract_bbox(cfg) -> ee.Geometry:
@@ -20,8 +26,9 @@ def extract_date_range(cfg):
 
 def feature2patch(cfg, patch: dict) -> ee.Geometry:
     coords = patch['geometry']['coordinates']
-    lower_left = coords[0][0]
-    upper_right = coords[0][2]
+    xmin, ymin, xmax, ymax = patch_geometry.polygon_bounds(coords[0])[0]
+    lower_left = [float(xmin), float(ymin)]
+    upper_right = [float(xmax), float(ymax)]
     # print(lower_left, upper_right)
     # crs = patch['geometry']['crs']['properties']['name']
     # geodesic = patch['geometry']['geodesic']
@@ -35,3 +42,48 @@ def normalize(min_value: float, max_value: float) -> callable:
         return img.subtract(min_value).divide(max_value - min_value).clamp(0, 1).copyProperties(img)
     return normalize_mapper
 
+
+def _config_value(cfg, key: str):
+    value = cfg
+    for name in key.split('.'):
+        value = value[name]
+    return value
+
+
+def config_hash(cfg, keys: list) -> str:
+    # short hash of the given config entries, e.g. to tell apart outputs of different processing parameters
+    values = {key: _config_value(cfg, key) for key in keys}
+    return hashlib.sha1(json.dumps(values, sort_keys=True, default=str).encode('utf-8')).hexdigest()[:8]
+
+
+def _graph_key(value) -> str:
+    if isinstance(value, ee.ComputedObject):
+        return value.serialize()
+    return json.dumps(value, sort_keys=True, default=str)
+
+
+def memoize_graph(*cfg_keys: str) -> callable:
+    # caches the ee object returned by a graph builder for the duration of the run. If config keys (e.g.
+    # 'ROI.UTM_EPSG') are given the first argument is the config and only these entries of it make up the cache key,
+    # all other arguments are always part of the key
+    def decorator(func: callable) -> callable:
+        cache = {}
+        lock = threading.Lock()
+
+        @wraps(func)
+        def wrapper(*args):
+            if cfg_keys:
+                cfg, other_args = args[0], args[1:]
+                key = [_graph_key(_config_value(cfg, cfg_key)) for cfg_key in cfg_keys]
+            else:
+                other_args = args
+                key = []
+            key = tuple(key + [_graph_key(arg) for arg in other_args])
+            with lock:
+                if key not in cache:
+                    cache[key] = func(*args)
+                return cache[key]
+
+        wrapper.cache_clear = cache.clear
+        return wrapper
+    return decorator